@@ -12,14 +12,30 @@ Additional code by Mike Schackwitz
 
 
 import time
-from datetime import datetime
+import calendar
+from bisect import bisect_right
+from functools import lru_cache
+from datetime import datetime, date
 import pytz
 from pytz import timezone
 
 import os
 import shutil
-import fnmatch
+import copy
 import sys, getopt
+import errno
+import hashlib
+import json
+import re
+import struct
+import select
+import signal
+import cProfile
+import collections
+import itertools
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
 import string
 
 
@@ -40,184 +56,1485 @@ def print_usage_message():
     print('   -l               When renaming, use local time (default)')
     print('   -u               When renaming, use UTC time')
     print('   -t               Tesy mode, do not rename anything, but write to a file what would be done')
+    print('   --workers <N>    Copy N files at the same time (default 1). Helps most on SSDs and fast card readers')
+    print('   --mode <mode>    How files get to the new folder: copy (default), hardlink, reflink, or inplace to')
+    print('                    rename the original files without copying them')
+    print('   --direct         Copy each file straight to its new name, instead of copying and then renaming')
+    print('   --jsonl          Also write amresults.jsonl, with one line of JSON for every file copied or renamed')
+    print('   --tz <zone>      Local time zone to use, e.g. America/Denver, instead of being asked for it')
+    print('   -y, --yes        Non-interactive: don\'t ask for anything. Needs -f or -a, -s, and --tz or -u')
+    print('   --on-problem <p> What to do about a problem instead of asking: continue, skip (the folder) or abort.')
+    print('                    With -y the default is abort')
+    print('   --jobs <N>       With -a, do N folders at the same time, each in its own process. Problems in')
+    print('                    a folder are skipped unless --on-problem says otherwise')
+    print('   --header <mode>  Read the recording time AudioMoth puts in the WAV header. fallback: only for files')
+    print('                    whose name has no time in it. check: also warn if the header and name disagree')
+    print('   --checksum       Make a BLAKE2b checksum of each file while copying it, saved to ammanifest.b2')
+    print('                    in the new folder (the same format as b2sum)')
+    print('   --verify <dir>   Check every ammanifest.b2 under <dir> against the files, then stop')
+    print('   --watch <dir>    Keep running, copying and renaming new recordings in <dir> as they finish arriving.')
+    print('                    Needs -s, and --tz or -u. Stop with Ctrl-C')
+    print('   --stream         For very big folders: copy files straight to their new names while the folder is')
+    print('                    still being read, instead of reading it all first. Files are checked as they come')
+    print('   --catalog <file> SQLite catalogue of recordings already ingested (made if it isn\'t there). Recordings')
+    print('                    in it are skipped, and every file renamed is added to it')
+    print('   --catalog-match <m> What makes two recordings the same: time (site and time), size (default: time and')
+    print('                    size) or hash (time, size and checksum, when the catalogue has one from --checksum)')
+    print('   --layout <l>     Where the renamed files go in the new folder: flat (default, all together), daily')
+    print('                    (a subfolder for each day, e.g. 2020-06-04/) or monthly (e.g. 2020-06/)')
+    print('   --integrity <p>  Check each WAV header against the file size to find files cut short (e.g. by a flat')
+    print('                    battery) before copying. report: list them, skip: list them and don\'t copy them')
+    print('   --order <o>      What order to copy files in: listing (default, the order the folder lists them),')
+    print('                    disk (where their data is on the disk or card, to save seeking) or time (recording time)')
+    print('   --buffer <MB>    Read up to this many MB at a time when copying big files (default 1)')
+    print('   --bwlimit <MB/s> Copy no faster than this, so the computer stays usable while a card is ingested.')
+    print('                    With --jobs the limit is shared between the jobs')
+    print('   --profile <file> Write cProfile stats for the run to <file>')
+    print('   --resume         Carry on from where an interrupted run on the same folder stopped')
     print('   -h               Display this help screen')
 
 
+#### One file found by scan_folder. Validation, copy and rename all work from these records so that
+#### each folder only has to be listed once.
+class FileRecord:
+    __slots__ = ("name", "path", "size", "timestamp", "valid")
+
+    def __init__(self, name, path, size, timestamp, valid):
+        self.name = name              # file name, including extension
+        self.path = path              # full path, using forward slashes
+        self.size = size              # size in bytes
+        self.timestamp = timestamp    # recording time parsed from the name, in seconds since 1970 UTC, or None
+                                      # if the name isn't hex or YYYYMMDD_HHMMSS
+        self.valid = valid            # True if this is a WAV file with a name we know how to convert
+
+
+# Latest time a datetime can hold (9999-12-31 23:59:59 UTC), in seconds since 1970
+MAX_TIMESTAMP = 253402300799
+
+# date.fromordinal() number of 1970-01-01
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+#### Get the UTC recording time out of a file name (with or without extension), in seconds since 1970.
+#### Return None if the name is neither a hex timestamp nor in the format YYYYMMDD_HHMMSS, or isn't a real time.
+#### This is plain integer arithmetic rather than datetime/strptime, because it runs on every file.
+def parse_timestamp(filename):
+    am_format = os.path.splitext(filename)[0]
+    try:
+        if am_format != "" and ishex(am_format):
+            seconds = int(am_format, 16)
+            if seconds > MAX_TIMESTAMP:
+                return None
+            return seconds
+
+        if is_valid_filename(am_format):
+            return timestamp_from_fields(int(am_format[0:4]), int(am_format[4:6]), int(am_format[6:8]),
+                                         int(am_format[9:11]), int(am_format[11:13]), int(am_format[13:15]))
+    except ValueError:
+        # isnumeric() lets through some characters that int() doesn't understand
+        pass
+    return None
+
+
+#### Seconds since 1970 for a UTC date and time, or None if it isn't a real time. These are the same
+#### checks strptime would make, e.g. no month 13 or February 30th.
+def timestamp_from_fields(year, month, day, hour, minute, second):
+    if year < 1 or not 1 <= month <= 12 or not 1 <= day <= calendar.monthrange(year, month)[1]:
+        return None
+    if hour > 23 or minute > 59 or second > 59:
+        return None
+    return calendar.timegm((year, month, day, hour, minute, second))
+
+
+#### Reading the recording time from the WAV header (--header)
+####   fallback  use the header for WAV files whose name isn't hex or YYYYMMDD_HHMMSS, e.g. renamed by hand
+####   check     the same, and also compare the header with the name of every other WAV file
+HEADER_MODES = ("fallback", "check")
+
+# How much of each file to read. The AudioMoth header, comment included, is well under this.
+HEADER_READ_BYTES = 4096
+
+# AudioMoth's comment, e.g. "Recorded at 21:00:00 24/02/2019 (UTC) by AudioMoth ..." or "... (UTC-5) ..."
+# The time is in the zone shown in brackets.
+HEADER_TIME_PATTERN = re.compile(rb"Recorded at (\d\d):(\d\d):(\d\d) (\d\d)/(\d\d)/(\d{4}) \(UTC(?:([+-])(\d{1,2})(?::(\d\d))?)?\)")
+
+
+#### Get the recording time out of the start of a WAV file (the bytes, not a file name), in seconds since
+#### 1970 UTC. Only the RIFF chunk headers are looked at until the ICMT comment in the LIST/INFO chunk
+#### turns up; None if there isn't one, or it doesn't have a time in it.
+def parse_wav_header_time(header):
+    if len(header) < 12 or header[0:4] != b"RIFF" or header[8:12] != b"WAVE":
+        return None
+
+    pos = 12
+    while pos + 8 <= len(header):
+        chunk_id = header[pos:pos + 4]
+        chunk_size = struct.unpack_from("<I", header, pos + 4)[0]
+        if chunk_id == b"data":
+            # The audio comes after all the chunks we care about
+            break
+        if chunk_id == b"LIST" and header[pos + 8:pos + 12] == b"INFO":
+            sub = pos + 12
+            end = min(pos + 8 + chunk_size, len(header))
+            while sub + 8 <= end:
+                sub_id = header[sub:sub + 4]
+                sub_size = struct.unpack_from("<I", header, sub + 4)[0]
+                if sub_id == b"ICMT":
+                    return parse_header_comment_time(header[sub + 8:sub + 8 + sub_size])
+                sub += 8 + sub_size + (sub_size & 1)
+        # Chunks are padded to an even length
+        pos += 8 + chunk_size + (chunk_size & 1)
+    return None
+
+
+#### The time in an AudioMoth comment, in seconds since 1970 UTC, or None
+def parse_header_comment_time(comment):
+    match = HEADER_TIME_PATTERN.search(comment)
+    if match is None:
+        return None
+    hour, minute, second, day, month, year = (int(field) for field in match.group(1, 2, 3, 4, 5, 6))
+    timestamp = timestamp_from_fields(year, month, day, hour, minute, second)
+    if timestamp is None:
+        return None
+    # The time is local to the offset in the brackets, so take the offset off to get UTC
+    if match.group(7) is not None:
+        offset = int(match.group(8)) * 3600 + int(match.group(9) or 0) * 60
+        timestamp += -offset if match.group(7) == b"+" else offset
+    return timestamp
+
+
+#### Read the recording time from the header of a WAV file, without reading the audio. None if it can't.
+def read_header_timestamp(path):
+    try:
+        with open(path, "rb") as f:
+            return parse_wav_header_time(f.read(HEADER_READ_BYTES))
+    except OSError:
+        return None
+
+
+#### Fill in times from the WAV headers, for header_mode "fallback" or "check" (see HEADER_MODES).
+#### Records whose name has no time but whose header does get that time and become valid; in "check"
+#### mode any WAV whose name and header disagree is reported. Only the files that need it are read.
+def apply_header_times(records, header_mode, results_file):
+    for record in records:
+        if not iswavfile(record.name):
+            continue
+        if record.timestamp is None:
+            timestamp = read_header_timestamp(record.path)
+            if timestamp is not None:
+                record.timestamp = timestamp
+                record.valid = True
+                results_file.add("Using the time in the WAV header for {0}: {1} UTC".format(
+                    record.path, datetime.utcfromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")))
+        elif header_mode == "check":
+            timestamp = read_header_timestamp(record.path)
+            if timestamp is not None and timestamp != record.timestamp:
+                msg = "Warning! The time in the WAV header of {0} ({1} UTC) doesn't match its name, using the name".format(
+                    record.path, datetime.utcfromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S"))
+                print(msg)
+                results_file.add(msg)
+
+
+#### Checking that WAV files aren't cut short (--integrity), e.g. by the AudioMoth's battery running out
+####   report  list the bad files in their own section of the report, but copy them anyway
+####   skip    list them, and leave them out of the copy
+INTEGRITY_POLICIES = ("report", "skip")
+
+# How many files to check at the same time, unless --workers says more
+INTEGRITY_WORKERS = 8
+
+
+#### What is wrong with a WAV file, from the first bytes of it (header) and its size, or None if it looks whole.
+#### The sizes in the RIFF header and the data chunk header have to fit in the file. Nothing past the
+#### header is read, so a file whose header is fine but whose audio is damaged won't be caught.
+def wav_integrity_problem(header, size):
+    if size == 0:
+        return "the file is empty"
+    if len(header) < 12 or header[0:4] != b"RIFF" or header[8:12] != b"WAVE":
+        return "not a RIFF/WAVE file"
+    riff_size = struct.unpack_from("<I", header, 4)[0]
+    if riff_size + 8 > size:
+        return "truncated: the header says {0} bytes but the file is {1}".format(riff_size + 8, size)
+
+    pos = 12
+    while pos + 8 <= len(header):
+        chunk_id = header[pos:pos + 4]
+        chunk_size = struct.unpack_from("<I", header, pos + 4)[0]
+        if chunk_id == b"data":
+            if pos + 8 + chunk_size > size:
+                return "truncated: the audio should end at byte {0} but the file is {1} bytes".format(pos + 8 + chunk_size, size)
+            return None
+        pos += 8 + chunk_size + (chunk_size & 1)
+    if pos >= size:
+        return "no audio: the file ends before the data chunk"
+    # The data chunk is further in than we read, so all we can say is that the header fits
+    return None
+
+
+#### wav_integrity_problem() for a file on disk
+def check_wav_file(path, size):
+    try:
+        with open(path, "rb") as f:
+            return wav_integrity_problem(f.read(HEADER_READ_BYTES), size)
+    except OSError as why:
+        return "can't be read: {0}".format(why)
+
+
+#### Check every WAV file in records on a pool of workers threads, reading just the header of each.
+#### Problems go in a section of their own in the report. Returns the records to go on with: all of them
+#### for policy "report", or the ones without problems for "skip".
+def check_integrity(records, policy, results_file, workers=INTEGRITY_WORKERS):
+    start = time.perf_counter()
+    wav_records = [record for record in records if iswavfile(record.name)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        problems = list(pool.map(lambda record: check_wav_file(record.path, record.size), wav_records))
+    bad = [(record, problem) for record, problem in zip(wav_records, problems) if problem is not None]
+    results_file.stats.add("integrity", time.perf_counter() - start, len(wav_records))
+    if not bad:
+        return records
+
+    section = add_action("")
+    section += add_action("Damaged WAV files ({0} of {1}){2}:".format(len(bad), len(wav_records), ", not copied" if policy == "skip" else ""))
+    for record, problem in bad:
+        section += add_action("   {0}: {1}".format(record.path, problem))
+    section += add_action("")
+    print(section)
+    results_file.write(section)
+
+    if policy == "skip":
+        bad_paths = set(record.path for record, problem in bad)
+        return [record for record in records if record.path not in bad_paths]
+    return records
+
+
+#### Table of UTC offsets for a time zone: a sorted list of the times (seconds since 1970 UTC) when
+#### each offset starts, and a matching list of offsets in seconds. This is the same table pytz uses
+#### inside astimezone(), built once per zone so converting a file is just a bisect.
+@lru_cache(maxsize=None)
+def utc_offset_table(zone_name):
+    tz = timezone(zone_name)
+    transition_times = getattr(tz, "_utc_transition_times", None)
+    if not transition_times:
+        # Zones like UTC that never change offset
+        return [0], [int(tz.utcoffset(datetime(2000, 1, 1)).total_seconds())]
+
+    epoch = datetime(1970, 1, 1)
+    starts = [int((t - epoch).total_seconds()) for t in transition_times]
+    offsets = [int(info[0].total_seconds()) for info in tz._transition_info]
+    return starts, offsets
+
+
+#### Convert a batch of UTC timestamps (seconds since 1970, or None) to the 'YYYY-MM-DD_HH-MM' strings
+#### used in the new file names, in target_tz. Gives exactly what astimezone() + strftime() would,
+#### but looks up the offset in a cached table and only calls strftime once per day.
+def format_local_times(timestamps, target_tz):
+    starts, offsets = utc_offset_table(target_tz.zone)
+    day_strings = {}
+    time_strs = []
+    for seconds in timestamps:
+        if seconds is None:
+            time_strs.append(None)
+            continue
+
+        local = seconds + offsets[max(0, bisect_right(starts, seconds) - 1)]
+        days, seconds_of_day = divmod(local, 86400)
+        day_str = day_strings.get(days)
+        if day_str is None:
+            try:
+                day_str = date.fromordinal(days + EPOCH_ORDINAL).strftime('%Y-%m-%d')
+            except (ValueError, OverflowError):
+                # The local time is before year 1 or after year 9999, so it can't be a file name
+                time_strs.append(None)
+                continue
+            day_strings[days] = day_str
+        time_strs.append("{0}_{1:02d}-{2:02d}".format(day_str, seconds_of_day // 3600, seconds_of_day % 3600 // 60))
+
+    return time_strs
+
+
+# Where a worker process for --jobs writes a folder's part of the report, until it is added to the main one
+SECTION_FILE = "amresults.section.txt"
+SECTION_JSONL_FILE = "amresults.section.jsonl"
+
+# Files this script writes into the source folder, which are never copied or renamed
+RESULTS_FILES = ("amresults.txt", "amresults.jsonl", "amjournal.jsonl", "amjournal.previous.jsonl", "ammanifest.b2", SECTION_FILE,
+                 SECTION_JSONL_FILE)
+
+
+#### Make one pass over a folder and return a FileRecord for every file in it (subfolders and our own
+#### results files are left out). The cost of this is linear in the number of files.
+#### If subdirs is a list, the names of the subfolders are added to it, so callers walking a tree
+#### don't need to list the folder again.
+def scan_folder(dir_name, subdirs=None):
+    return list(iter_folder(dir_name, subdirs))
+
+
+#### The same as scan_folder, one record at a time as the folder is read, for going through folders too
+#### big to hold all at once (--stream)
+def iter_folder(dir_name, subdirs=None):
+    with os.scandir(dir_name) as it:
+        for entry in it:
+            if subdirs is not None and entry.is_dir():
+                subdirs.append(entry.name)
+                continue
+            if entry.name in RESULTS_FILES or not entry.is_file():
+                continue
+            yield make_record(dir_name, entry.name, entry.stat().st_size)
+
+
+#### The FileRecord for the file called name in dir_name
+def make_record(dir_name, name, size):
+    timestamp = parse_timestamp(name)
+    return FileRecord(name, os.path.join(dir_name, name).replace('\\', '/'), size, timestamp,
+                      iswavfile(name) and timestamp is not None)
+
+
+#### One scan of a whole folder tree, for -a. Every folder is listed once, and the records (with the
+#### sizes from each DirEntry) are kept so that validation, copy and rename all use them instead of
+#### walking the tree again. Folders are known by their path relative to the current folder, the same
+#### way the rest of the script names them. listings_saved counts the directory listings the cache
+#### saved: each time a folder's files or subfolders are taken from it instead of listing it again.
+class TreeScan:
+    def __init__(self, root_dir='.'):
+        self.root_dir = root_dir
+        self.folders = {}   # path -> (records, subfolder names), in the order they were found (parents first)
+        self.listings_saved = 0
+        self.file_count = 0
+
+        to_scan = [(root_dir, True)]    # (folder, whether to look in its subfolders too)
+        while to_scan:
+            dir_name, recurse = to_scan.pop()
+            subdirs = []
+            records = scan_folder(dir_name, subdirs)
+            self.folders[dir_name] = (records, subdirs)
+            self.file_count += len(records)
+            if not recurse:
+                continue
+            # Don't follow links to folders, same as os.walk(), except for links to site folders: -a copies
+            # those like any other site, so their files are scanned, but not the folders inside them
+            children = [self.child_path(dir_name, name) for name in subdirs]
+            to_scan.extend(reversed([(child, not os.path.islink(child)) for child in children
+                                     if dir_name == root_dir or not os.path.islink(child)]))
+
+    #### Path of a folder inside dir_name, written the way the user would ('site1', not './site1')
+    def child_path(self, dir_name, name):
+        if dir_name == self.root_dir:
+            return name
+        return os.path.join(dir_name, name)
+
+    #### The records for a folder, from the cache
+    def records(self, dir_name):
+        self.listings_saved += 1
+        return self.folders[dir_name][0]
+
+    #### Names of the subfolders of a folder, from the cache
+    def subfolders(self, dir_name):
+        self.listings_saved += 1
+        return self.folders[dir_name][1]
+
+    def summary(self):
+        return ("Scanned {0} folders and {1} files once; reusing the scan saved {2} directory listings"
+                .format(len(self.folders), self.file_count, self.listings_saved))
+
+
+#### Ways of getting the files into the destination folder (--mode)
+####   copy      make a real copy of every file (default)
+####   hardlink  add a second name for the same data; source and destination must be on the same drive
+####   reflink   copy-on-write clone, for filesystems that support it (Btrfs, XFS); elsewhere a normal copy
+####   inplace   don't make a new folder at all, just rename the files where they are
+INGEST_MODES = ("copy", "hardlink", "reflink", "inplace")
+
+# ioctl number for FICLONE on Linux, used to make reflinks
+FICLONE = 0x40049409
+
+# Errors from copy_file_range that just mean "can't do it here", so fall back to a normal copy
+COPY_FILE_RANGE_FALLBACK_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP)
+
+# Errors from a reflink that mean the filesystem can't clone (e.g. ext4, or two different drives), so the
+# file is copied instead, like cp --reflink=auto
+REFLINK_FALLBACK_ERRORS = (errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOTTY)
+
+
+#### Copy the data of src to dest, letting the kernel move the bytes if it can (copy_file_range), and
+#### keep the timestamps like shutil.copy2 does. schedule, if given, is a CopySchedule: the copy is then done
+#### a buffer at a time, so --buffer sets how much is moved at once and a bandwidth limit can slow it down.
+def copy_file_data(src, dest, schedule=None):
+    if os.path.exists(dest) and os.path.samefile(src, dest):
+        raise shutil.SameFileError("{0} and {1} are the same file".format(src, dest))
+    limit = schedule.limit if schedule is not None else None
+
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(src, "rb") as fsrc, open(dest, "wb") as fdst:
+                size = os.fstat(fsrc.fileno()).st_size
+                remaining = size
+                # Without a schedule the kernel can move the whole file in one call
+                block = schedule.buffer_size if schedule is not None else remaining
+                while remaining > 0:
+                    if limit is not None:
+                        limit.take(min(block, remaining))
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), min(block, remaining))
+                    if copied == 0:
+                        # Never leave a short copy behind. Either the file got shorter while it was being
+                        # copied, or this filesystem says it can do copy_file_range but doesn't.
+                        if os.fstat(fsrc.fileno()).st_size < size:
+                            raise OSError(errno.EIO, "{0} got shorter while it was being copied".format(src))
+                        break
+                    remaining -= copied
+            if remaining == 0:
+                shutil.copystat(src, dest)
+                return
+        except OSError as why:
+            if why.errno not in COPY_FILE_RANGE_FALLBACK_ERRORS:
+                raise
+
+    if schedule is not None:
+        copy_blocks(src, dest, schedule.buffer_size, limit)
+        return
+
+    # shutil uses sendfile on Linux and the fast copy calls on Windows and macOS
+    shutil.copy2(src, dest)
+
+
+#### Make dest a hard link to src, replacing whatever is already called dest
+def link_file(src, dest):
+    if os.path.exists(dest) and os.path.samefile(src, dest):
+        raise shutil.SameFileError("{0} and {1} are the same file".format(src, dest))
+    try:
+        os.link(src, dest)
+    except FileExistsError:
+        os.remove(dest)
+        os.link(src, dest)
+
+
+#### Make dest a copy-on-write clone of src. Raises OSError if the filesystem can't do it.
+def reflink_file(src, dest):
+    if os.path.exists(dest) and os.path.samefile(src, dest):
+        raise shutil.SameFileError("{0} and {1} are the same file".format(src, dest))
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError(errno.EOPNOTSUPP, "reflink is not supported on this system")
+
+    try:
+        with open(src, "rb") as fsrc, open(dest, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        # Don't leave an empty file behind that would then get renamed as if it were a recording
+        os.remove(dest)
+        raise
+    shutil.copystat(src, dest)
+
+
+#### Checksums (--checksum). BLAKE2b, as made by b2sum, so the manifest can be checked without this script too.
+MANIFEST_FILE = "ammanifest.b2"
+
+# Bytes read at a time when copying with a checksum or checking one, unless --buffer says otherwise
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# How many files --verify reads at the same time, unless --workers says otherwise
+VERIFY_WORKERS = 4
+
+
+#### Copy src to dest through a buffer of up to buffer_size bytes, keeping the timestamps. The buffer is no
+#### bigger than the file, so small files don't pay for a big one. limit, if given, is a BandwidthLimit to
+#### wait on before each block, and hasher a hashlib object to give each block to.
+def copy_blocks(src, dest, buffer_size=COPY_BUFFER_SIZE, limit=None, hasher=None):
+    with open(src, "rb", buffering=0) as fsrc, open(dest, "wb", buffering=0) as fdst:
+        buffer = bytearray(max(1, min(buffer_size, os.fstat(fsrc.fileno()).st_size)))
+        view = memoryview(buffer)
+        while True:
+            length = fsrc.readinto(buffer)
+            if not length:
+                break
+            if hasher is not None:
+                hasher.update(view[:length])
+            if limit is not None:
+                limit.take(length)
+            written = 0
+            while written < length:
+                written += fdst.write(view[written:length])
+    shutil.copystat(src, dest)
+
+
+#### Copy src to dest, working out the checksum of the data on the way through, and return the checksum.
+#### Each block is read once and goes both to the new file and the hash, so there is no second pass over
+#### the card. This can't use copy_file_range, as the data has to come through here to be hashed.
+#### schedule, if given, is a CopySchedule with the buffer size and bandwidth limit to use.
+def copy_and_hash(src, dest, schedule=None):
+    if os.path.exists(dest) and os.path.samefile(src, dest):
+        raise shutil.SameFileError("{0} and {1} are the same file".format(src, dest))
+
+    hasher = hashlib.blake2b()
+    if schedule is not None:
+        copy_blocks(src, dest, schedule.buffer_size, schedule.limit, hasher)
+    else:
+        copy_blocks(src, dest, hasher=hasher)
+    return hasher.hexdigest()
+
+
+#### The checksum of a file
+def hash_file(path):
+    hasher = hashlib.blake2b()
+    buffer = bytearray(COPY_BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            length = f.readinto(buffer)
+            if not length:
+                break
+            hasher.update(view[:length])
+    return hasher.hexdigest()
+
+
+#### Read a manifest into a dict of file name -> checksum, in the order of the file
+def read_manifest(filename):
+    digests = {}
+    with open(filename) as f:
+        for line in f:
+            digest, sep, name = line.rstrip("\n").partition("  ")
+            if sep:
+                digests[name] = digest
+    return digests
+
+
+#### The checksums of the files in a destination folder, kept in ammanifest.b2 in that folder in the same
+#### format as b2sum, so "b2sum -c ammanifest.b2" checks it too. Entries are by file name, and a file
+#### renamed after it was copied is renamed here as well. Whatever was already in the manifest is kept.
+class Manifest:
+    def __init__(self, dir_name):
+        self.filename = os.path.join(dir_name, MANIFEST_FILE).replace('\\', '/')
+        self.digests = read_manifest(self.filename) if os.path.exists(self.filename) else {}
+        self.saved = set(self.digests)  # names as they are in the file
+        self.new_names = {}             # names added since it was written (a dict, to keep them in order)
+        self.rewrite = False            # True if something already in the file has changed
+
+    def add(self, name, digest):
+        if name in self.saved:
+            self.rewrite = self.rewrite or self.digests[name] != digest
+        else:
+            self.new_names[name] = None
+        self.digests[name] = digest
+
+    def rename(self, old_name, new_name):
+        if old_name in self.digests:
+            self.digests[new_name] = self.digests.pop(old_name)
+            if old_name in self.saved:
+                self.rewrite = True
+            else:
+                self.new_names.pop(old_name, None)
+                self.new_names[new_name] = None
+
+    #### Write the manifest, if anything was added since it was last written. If only new files were added
+    #### (e.g. each batch of --watch), they are added to the end, so a long run doesn't write the whole
+    #### manifest again each time. Otherwise it is written to a new file that then replaces the old one, so
+    #### a run that stops part way doesn't leave half a manifest.
+    def save(self, results_file):
+        if self.rewrite:
+            with open(self.filename + ".tmp", "w") as f:
+                f.write("".join("{0}  {1}\n".format(digest, name) for name, digest in self.digests.items()))
+            os.replace(self.filename + ".tmp", self.filename)
+            results_file.add("Wrote checksums for {0} files to {1}".format(len(self.digests), self.filename))
+        elif self.new_names:
+            with open(self.filename, "a") as f:
+                f.write("".join("{0}  {1}\n".format(self.digests[name], name) for name in self.new_names))
+            results_file.add("Added checksums for {0} files to {1}".format(len(self.new_names), self.filename))
+        else:
+            return
+        self.saved = set(self.digests)
+        self.new_names = {}
+        self.rewrite = False
+
+
+#### Check the files in dir_name against its manifest, reading up to workers files at the same time.
+#### Returns how many files were checked and a list of (name, problem) for those that are missing or differ.
+def verify_folder(dir_name, workers=VERIFY_WORKERS):
+    digests = read_manifest(os.path.join(dir_name, MANIFEST_FILE))
+
+    def check(name):
+        try:
+            if hash_file(os.path.join(dir_name, name)) != digests[name]:
+                return "checksum doesn't match"
+        except FileNotFoundError:
+            return "missing"
+        except OSError as why:
+            return "can't be read: {0}".format(why)
+        return None
+
+    # hashlib lets go of the GIL while it hashes, so threads are enough to keep several reads going
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        problems = list(pool.map(check, digests))
+    return len(digests), [(name, problem) for name, problem in zip(digests, problems) if problem is not None]
+
+
+#### Check every folder with a manifest under root_dir (--verify). Prints what it finds.
+#### Returns True if there was at least one manifest and every file in them matched.
+def verify_archive(root_dir, workers=VERIFY_WORKERS):
+    ok = True
+    found = 0
+    for dir_name, sub_dir_list, file_list in os.walk(root_dir):
+        sub_dir_list.sort()
+        if MANIFEST_FILE not in file_list:
+            continue
+        found += 1
+        checked, problems = verify_folder(dir_name, workers)
+        for name, problem in problems:
+            print("Error! {0}: {1}".format(os.path.join(dir_name, name).replace('\\', '/'), problem))
+        print("{0}: {1} files checked, {2} problems".format(dir_name.replace('\\', '/'), checked, len(problems)))
+        if problems:
+            ok = False
+    if found == 0:
+        print("Error! No {0} found in {1}".format(MANIFEST_FILE, root_dir))
+        return False
+    return ok
+
+
+#### Copy scheduling: what order the files are copied in, how big a buffer is used and how fast it may go.
+#### Reading an SD card or a disk in the order the data lies on it, rather than the order the folder
+#### happens to list the files in, saves seeking and lets read-ahead do its job.
+####   listing  the order the folder lists them in (the default)
+####   disk     where each file's data starts on the disk, from the filesystem's block map (FIEMAP).
+####            If the filesystem doesn't have one, by inode number, which is usually close to the order
+####            the files were written in
+####   time     by recording time, which on a card the AudioMoth filled is also roughly the order they
+####            were written in
+COPY_ORDERS = ("listing", "disk", "time")
+
+# ioctl number for FS_IOC_FIEMAP on Linux, and the layout of struct fiemap with room for one extent
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_HEADER = struct.Struct("=QQIIII")
+FIEMAP_EXTENT_SIZE = 56
+
+# Errors from FIEMAP that mean the filesystem (or system) can't say where files are
+FIEMAP_UNSUPPORTED_ERRORS = (errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOTTY, errno.ENOSYS, errno.EINVAL)
+
+
+#### Where the data of a file starts on the disk, in bytes, or 0 if it has none.
+#### Raises OSError with one of FIEMAP_UNSUPPORTED_ERRORS if the filesystem can't say.
+def disk_position(path):
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError(errno.EOPNOTSUPP, "FIEMAP is not supported on this system")
+
+    request = bytearray(FIEMAP_HEADER.size + FIEMAP_EXTENT_SIZE)
+    # From the start, to the end of the file, one extent
+    FIEMAP_HEADER.pack_into(request, 0, 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0)
+    with open(path, "rb") as f:
+        fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, request)
+    if FIEMAP_HEADER.unpack_from(request)[3] == 0:
+        return 0
+    # fe_physical comes after fe_logical in the first extent
+    return struct.unpack_from("=Q", request, FIEMAP_HEADER.size + 8)[0]
+
+
+#### Sort keys for copying records in disk order, and how they were found ("block map" or "inode")
+def disk_order_keys(records):
+    keys = []
+    for record in records:
+        try:
+            keys.append(disk_position(record.path))
+        except OSError as why:
+            if why.errno in FIEMAP_UNSUPPORTED_ERRORS:
+                break
+            # e.g. the file has gone; the copy will report it
+            keys.append(0)
+    else:
+        return keys, "block map"
+
+    keys = []
+    for record in records:
+        try:
+            keys.append(os.stat(record.path).st_ino)
+        except OSError:
+            keys.append(0)
+    return keys, "inode"
+
+
+#### Limit how fast the copies go (--bwlimit), so the computer stays usable while a card is ingested.
+#### Shared by all the copy threads: each block waits for its turn, so together they stay under the limit.
+class BandwidthLimit:
+    def __init__(self, bytes_per_second):
+        self.rate = bytes_per_second
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    #### Wait until size more bytes can be copied
+    def take(self, size):
+        with self.lock:
+            now = time.monotonic()
+            start = max(self.next_time, now)
+            self.next_time = start + size / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+#### How one folder's copies are done: order is one of COPY_ORDERS, buffer_size the most bytes read at
+#### a time, and bandwidth the most bytes a second to copy, or None for as fast as possible.
+class CopySchedule:
+    def __init__(self, order="listing", buffer_size=COPY_BUFFER_SIZE, bandwidth=None):
+        self.order = order
+        self.buffer_size = buffer_size
+        self.bandwidth = bandwidth
+        self.limit = BandwidthLimit(bandwidth) if bandwidth else None
+
+    #### Put records, and the dest_names that go with them, in the order to copy them in
+    def arrange(self, records, dest_names, results_file):
+        if self.order == "time":
+            keys = [(record.timestamp is None, record.timestamp or 0, record.name) for record in records]
+        elif self.order == "disk":
+            start = time.perf_counter()
+            keys, source = disk_order_keys(records)
+            results_file.add("Copy order: disk, by {0} ({1} files in {2:.2f} s)".format(source, len(records), time.perf_counter() - start))
+        else:
+            return records, dest_names
+        order = sorted(range(len(records)), key=keys.__getitem__)
+        return [records[i] for i in order], [dest_names[i] for i in order]
+
+    #### For the report, e.g. "order disk, 8 MB buffer, at most 20.0 MB/s"
+    def describe(self):
+        text = "order {0}, {1:g} MB buffer".format(self.order, self.buffer_size / (1024 * 1024))
+        if self.bandwidth:
+            text += ", at most {0:.1f} MB/s".format(self.bandwidth / 1e6)
+        return text
+
+
+#### Copy a single file into to_dir. Return the log text for it, True/False for whether it worked,
+#### where it went, how many seconds it took and its checksum (None unless checksum=True).
+#### dest_name is the name to give the copy; by default it keeps its own name.
+#### schedule, if given, is the CopySchedule with the buffer size and bandwidth limit for copies.
+#### This runs on the copy worker threads, so it must not touch anything shared.
+def copy_one_file(record, to_dir, test_mode, mode="copy", dest_name=None, checksum=False, schedule=None):
+    actions = ""
+    result = True
+    digest = None
+    full_path_filename = record.path
+    dest = os.path.join(to_dir, dest_name or record.name).replace('\\', '/')
+    start = time.perf_counter()
+    try:
+        if test_mode:
+            #In test mode, just make empty files
+            actions += add_action("Copying: {0} to {1}".format(full_path_filename, dest))
+            f = open(dest, "w")
+            f.close()
+        elif mode == "hardlink":
+            actions += add_action("Linking: {0} to {1}".format(full_path_filename, dest))
+            link_file(full_path_filename, dest)
+            if checksum:
+                digest = hash_file(dest)
+        elif mode == "reflink":
+            try:
+                reflink_file(full_path_filename, dest)
+                actions += add_action("Cloning: {0} to {1}".format(full_path_filename, dest))
+                if checksum:
+                    digest = hash_file(dest)
+            except OSError as why:
+                if why.errno not in REFLINK_FALLBACK_ERRORS:
+                    actions += add_action("Cloning: {0} to {1}".format(full_path_filename, dest))
+                    raise
+                actions += add_action("Copying (can't clone here): {0} to {1}".format(full_path_filename, dest))
+                if checksum:
+                    digest = copy_and_hash(full_path_filename, dest, schedule)
+                else:
+                    copy_file_data(full_path_filename, dest, schedule)
+        elif checksum:
+            actions += add_action("Copying: {0} to {1}".format(full_path_filename, dest))
+            digest = copy_and_hash(full_path_filename, dest, schedule)
+        else:
+            actions += add_action("Copying: {0} to {1}".format(full_path_filename, dest))
+            copy_file_data(full_path_filename, dest, schedule)
+
+    except shutil.SameFileError:
+        actions += add_action("Error! {0} has the same source and destination!".format(full_path_filename))
+        result = False
+    
+    except shutil.Error as why:
+        actions += add_action("Error! {0} at {1}".format(why, full_path_filename))
+        result = False
+    
+    except OSError as why:
+        actions += add_action(("Error! OS error: {0} at {1}".format(why, full_path_filename)))
+        result = False
+
+    return actions, result, dest, time.perf_counter() - start, digest
+
+
 #### Copy files to new directory
 #### Return True if it worked, False if at least one error happened
-def copy_files_to_new_dir(from_dir, to_dir, test_mode, results_file):
+#### If the caller already scanned from_dir it can pass the records in so we don't list the folder again
+#### With workers > 1 the copies run on a thread pool; the log is still written in the same order as the records
+#### mode is one of INGEST_MODES except "inplace"
+#### dest_names, if given, has the name to copy each record to (same order as records, None = keep the name)
+#### journal, if given, is the folder's Journal: files it says are already copied are left out
+#### manifest, if given, is the Manifest for to_dir: each file's checksum is worked out as it is copied and added to it
+#### catalogue, if given, is the Catalogue to add each file copied to a new name (from dest_names) to
+#### schedule, if given, is a CopySchedule with the order to copy the files in, the buffer size and a bandwidth limit.
+#### The report then says how fast the copy went with it.
+def copy_files_to_new_dir(from_dir, to_dir, test_mode, results_file, records=None, workers=1, mode="copy", dest_names=None,
+                          journal=None, manifest=None, catalogue=None, schedule=None):
     result = True
-    actions = ""
+    checksum = manifest is not None
+
+    if records is None:
+        records = scan_folder(from_dir)
+    if dest_names is None:
+        dest_names = [None] * len(records)
+
+    op = "test" if test_mode else mode
 
-    original_dir = os.listdir(from_dir)
     #Check if we found any files or not
-    if original_dir:
-        for item in original_dir:
-            for root, dirs, files in os.walk(from_dir):
-                for basename in files:
-                    if basename != "amresults.txt":
-                        if fnmatch.fnmatch(basename, item):
-                            full_path_filename = os.path.join(root, basename).replace('\\', '/')
-                            dest = os.path.join(to_dir, basename).replace('\\', '/')
-                            try:
-                                actions += add_action("Copying: {0} to {1}".format(full_path_filename, dest))
-                                if test_mode:
-                                    #In test mode, just make empty files
-                                    test_filename = os.path.join(to_dir, basename).replace('\\', '/')
-                                    f = open(test_filename, "w")
-                                    f.close()
-                                else:
-                                    shutil.copy2(full_path_filename, to_dir)
-
-                            except shutil.SameFileError:
-                                actions += add_action("Error! {0} has the same source and destination!".format(full_path_filename))
-                                result = False
-                            
-                            except shutil.Error as why:
-                                actions += add_action("Error! {0} at {1}".format(why, full_path_filename))
-                                result = False
-                            
-                            except OSError as why:
-                                actions += add_action(("Error! OS error: {0} at {1}".format(why, full_path_filename)))
-                                result = False
+    if records and journal is not None:
+        # Leave out what an earlier run already copied, and write down the rest before starting on it
+        todo = [(record, dest_name) for record, dest_name in zip(records, dest_names) if not journal.is_done("copy", record.path)]
+        if len(todo) < len(records):
+            results_file.add("Resuming: {0} files were already copied, {1} left to copy".format(len(records) - len(todo), len(todo)))
+            if checksum:
+                # The earlier run wrote down the checksums of the files it copied
+                for record in records:
+                    digest = journal.digest("copy", record.path)
+                    if digest is not None:
+                        manifest.add(relative_name(journal.planned_dst("copy", record.path), to_dir), digest)
+        records = [record for record, dest_name in todo]
+        dest_names = [dest_name for record, dest_name in todo]
+        journal.plan("copy", [(record.path, os.path.join(to_dir, dest_name or record.name).replace('\\', '/'))
+                              for record, dest_name in todo])
+        if not records:
+            return True
+
+    if records:
+        start = time.perf_counter()
+        if schedule is not None:
+            records, dest_names = schedule.arrange(records, dest_names, results_file)
+        total_bytes = sum(record.size for record in records)
+        progress = Progress("Copying", len(records), total_bytes)
+        pool = None
+        if workers > 1:
+            pool = ThreadPoolExecutor(max_workers=workers)
+            # map() hands back the results in the order of records, not the order they finish. The files
+            # are handed out in that order too, so the workers between them keep to the schedule's order.
+            outcomes = pool.map(lambda record, dest_name: copy_one_file(record, to_dir, test_mode, mode, dest_name, checksum, schedule),
+                                records, dest_names)
+        else:
+            outcomes = (copy_one_file(record, to_dir, test_mode, mode, dest_name, checksum, schedule)
+                        for record, dest_name in zip(records, dest_names))
+
+        # Write each file's results out as soon as it is done, rather than saving them all up
+        for record, dest_name, (file_actions, file_result, dest, duration, digest) in zip(records, dest_names, outcomes):
+            results_file.write(file_actions)
+            results_file.record(op, record.path, dest, record.size, duration, "ok" if file_result else "error", digest)
+            if file_result and digest is not None:
+                manifest.add(dest_name or record.name, digest)
+            if file_result and journal is not None:
+                journal.done("copy", record.path, dest, digest)
+            if file_result and catalogue is not None and dest_name is not None:
+                catalogue.add(record, dest, digest)
+            if file_result == False:
+                #Print the error so the user knows whether to try to continue
+                progress.clear()
+                print(file_actions)
+                result = False
+            progress.update(record.size)
+
+        if pool is not None:
+            pool.shutdown()
+        progress.done()
+        seconds = time.perf_counter() - start
+        results_file.stats.add("copy", seconds, len(records), total_bytes)
+        if schedule is not None and seconds > 0:
+            results_file.add("Copied {0} files, {1:.1f} MB in {2:.2f} s ({3:.1f} MB/s) with {4}".format(
+                len(records), total_bytes / 1e6, seconds, total_bytes / 1e6 / seconds, schedule.describe()))
     else:
         result = False
-        actions += add_action("Error! Source directory is empty, no files found.")
-    
-    #Print the results if there was an error somewhere so the user knows whether to try to continue
-    if result == False:
-        print(actions)
-    results_file.write(actions)
+        msg = "Error! Source directory is empty, no files found."
+        print(msg)
+        results_file.add(msg)
 
     return result
 
 
-#### Go through a folder and rename all the files
-def rename_files(to_dir, site_name, target_tz, test_mode, results_file):
-    result = True
-    actions = ""
+#### Streaming (--stream): for folders with so many files that scanning them all before starting takes a
+#### long time and a lot of memory. The folder is read a chunk at a time; each chunk is validated and named,
+#### and its files handed to the copy workers, while the scan waits if too many copies are still queued.
+#### Only a few chunks are ever held at once, and the first copy starts as soon as the first chunk is read.
+#### Files go straight to their new names. New names are claimed by creating the file, which fails if the
+#### name is taken, instead of keeping a list of every name in the folder. Names are claimed one at a time
+#### before the copies are handed out, so when files in a chunk share a minute the RENAME ERROR numbers
+#### go in time order, whatever order the copies finish in.
+
+# Files read from the folder at a time, then validated and named together
+STREAM_CHUNK_SIZE = 256
+
+# Most copies waiting for each worker before the scan stops to let them catch up
+STREAM_QUEUE_PER_WORKER = 4
 
-    new_dir = os.listdir(to_dir)
-    
-    if new_dir:
-        for item in new_dir:
-            for root, dirs, files in os.walk(to_dir):
-                for basename in files:
-                    if fnmatch.fnmatch(basename, item):
-                        absolute_path = os.path.join(root, basename).replace('\\', '/')
-
-            # get the full file name
-            debug('Test and then rename ' + absolute_path)
-            if iswavfile(absolute_path):
-                file = os.path.splitext(absolute_path)[0]
-                file_OK = True
-
-                # Split off file name and convert. If it's valid hex then convert to decimal to calculate date string
-                am_format = os.path.split(file)[1]
-                if ishex(am_format):
-                    debug('Filename is hex: ' + am_format)
-                    hex_str = '0x' + am_format
-
-                    # Get a datetime object with the time in UTC
-                    dt = datetime.utcfromtimestamp(int(hex_str,16)).replace(tzinfo=pytz.utc)
 
+#### Split an iterable into lists of up to size items
+def chunks(iterable, size):
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+#### The new name for a record without the .WAV (None if it can't be renamed), and the log text, for stream_folder
+def stream_new_name(record, time_str, site_name, test_mode):
+    if not iswavfile(record.name):
+        msg = "Error! Wrong file type, file not renamed: {0}".format(record.path)
+        print(msg)
+        return None, add_action(msg)
+    if time_str is None:
+        msg = "Error! Filename is not valid, file not renamed: {0}  ".format(record.path)
+        print(msg)
+        return None, add_action(msg)
+    if test_mode:
+        return os.path.splitext(record.name)[0] + " --to-- " + site_name + '-' + time_str, ""
+    return site_name + '-' + time_str, ""
+
+
+#### Take the first free name of base_name.WAV, base_name RENAME ERROR 1.WAV, ... in to_dir by making an
+#### empty file with it. Returns the name and the log text about any that were taken.
+def claim_new_name(to_dir, base_name, src):
+    actions = ""
+    new_file_name = base_name + '.WAV'
+    i = 1
+    while True:
+        dst = os.path.join(to_dir, new_file_name)
+        try:
+            open(dst, "xb").close()
+            return new_file_name, actions
+        except FileExistsError:
+            # Two files just a few seconds apart get the same name when rounded to the minute
+            actions += add_action('Tried to rename ' + src + ' to ' + dst + ' but that file already exists. Trying new name.')
+            new_file_name = base_name + ' RENAME ERROR ' + str(i) + '.WAV'
+            i += 1
+            actions += add_action("Trying {0}".format(os.path.join(to_dir, new_file_name)))
+
+
+#### Copy one file to the name claim_new_name took for it (dest_name, or None to keep its own name), for
+#### stream_folder, on a worker thread. Returns copy_one_file's results.
+def stream_one_file(record, to_dir, dest_name, test_mode, mode, checksum, schedule=None):
+    copy_actions, result, dest, duration, digest = copy_one_file(record, to_dir, test_mode, mode, dest_name, checksum, schedule)
+    if not result and dest_name is not None and os.path.exists(dest) and os.path.getsize(dest) == 0:
+        # Don't leave the empty file that claimed the name looking like a recording
+        os.remove(dest)
+    return copy_actions, result, dest, duration, digest
+
+
+#### Copy every file in from_dir straight to its new name in to_dir, a chunk at a time (see above).
+#### on_problem and header_mode are for validating each chunk, as in validate_all_files; if it says to skip
+#### the folder, the rest of it is left. manifest, if given, gets the checksum of each file.
+#### catalogue, if given, is a Catalogue: files already in it are skipped, and the new ones are added.
+#### layout is one of LAYOUTS; each subfolder is made the first time a file goes in it.
+#### integrity is one of INTEGRITY_POLICIES to check each chunk's WAV headers before copying it, or None.
+#### schedule, if given, is a CopySchedule for the buffer size and bandwidth limit. Its order isn't used, as
+#### the files have to be copied in the order they are read and named.
+#### Returns True if everything worked, False if there was an error.
+def stream_folder(from_dir, to_dir, site_name, target_tz, test_mode, results_file, workers=1, mode="copy", on_problem=None,
+                  header_mode=None, manifest=None, catalogue=None, layout="flat", integrity=None, schedule=None):
+    result = True
+    op = "test" if test_mode else mode
+    checksum = manifest is not None
+    files = 0
+    total_bytes = 0
+    validate_seconds = 0.0
+    check_seconds = 0.0    # checking integrity and the catalogue, which aren't part of the copy
+    start = time.perf_counter()
+    progress = Progress("Copying", None)
+    # With one worker the files are just done one after the other here, as handing each one to a
+    # thread costs more than it saves
+    pool = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+    in_flight = collections.deque()    # (record, log text, naming log text, future) in the order the files were read
+    made_shards = set()
+
+    #### Log the next file to finish, in order. False if anything went wrong with it.
+    def finish_next():
+        record, actions, name_actions, future = in_flight.popleft()
+        copy_actions, file_result, dest, duration, digest = future.result()
+        if file_result and catalogue is not None and record.timestamp is not None:
+            catalogue.add(record, dest, digest)
+        if name_actions:
+            progress.clear()
+            print(name_actions)
+        results_file.write(actions + name_actions + copy_actions)
+        results_file.record(op, record.path, dest, record.size, duration, "ok" if file_result else "error", digest)
+        if not file_result:
+            progress.clear()
+            print(copy_actions)
+        elif digest is not None:
+            manifest.add(relative_name(dest, to_dir), digest)
+        progress.update(record.size)
+        return file_result and not name_actions and not actions
+
+    try:
+        for chunk in chunks(iter_folder(from_dir), STREAM_CHUNK_SIZE):
+            validate_start = time.perf_counter()
+            valid = validate_all_files(chunk, results_file, on_problem, header_mode)
+            validate_seconds += time.perf_counter() - validate_start
+            if not valid:
+                results_file.add("Skipping the rest of folder:" + from_dir)
+                result = False
+                break
+            check_start = time.perf_counter()
+            if integrity is not None:
+                chunk = check_integrity(chunk, integrity, results_file, max(workers, INTEGRITY_WORKERS))
+            if catalogue is not None:
+                chunk = catalogue.skip_known(chunk, results_file)
+            check_seconds += time.perf_counter() - check_start
+
+            # Earliest first, so within a chunk the plain name goes to the first file of the minute
+            chunk.sort(key=lambda record: (record.timestamp is None, record.timestamp or 0, record.name))
+            time_strs = format_local_times([record.timestamp for record in chunk], target_tz)
+            for record, time_str in zip(chunk, time_strs):
+                base_name, actions = stream_new_name(record, time_str, site_name, test_mode)
+                shard = shard_name(time_str, layout) if base_name is not None else None
+                if shard is not None:
+                    if shard not in made_shards:
+                        os.makedirs(os.path.join(to_dir, shard), exist_ok=True)
+                        made_shards.add(shard)
+                    base_name = shard + '/' + base_name
+                # Claimed here rather than on the workers, so the names go in time order
+                dest_name = None
+                name_actions = ""
+                if base_name is not None:
+                    dest_name, name_actions = claim_new_name(to_dir, base_name, record.path)
+                if pool is not None:
+                    future = pool.submit(stream_one_file, record, to_dir, dest_name, test_mode, mode, checksum, schedule)
                 else:
-                    # file name not hex
-                    debug('Filename is not hex: ' + am_format)
-
-                    # Confirm that the filename is in this format: YYYYMMDD_HHMMSS
-                    if is_valid_filename(am_format):
-                        dt = pytz.utc.localize(datetime.strptime(am_format, "%Y%m%d_%H%M%S"))
-                    else:
-                        msg = "Error! Filename is not valid, file not renamed: {0}  ".format(absolute_path)
-                        print(msg)
-                        actions += add_action(msg)
-                        result = False
-                        file_OK = False
-
-                if file_OK:  
-                    #Since dt object above is in UTC, need to convert it to correct tz if necessary
-                    if  target_tz.zone != pytz.utc.zone:
-                        dt = dt.astimezone(target_tz)
-
-                    time_str = dt.strftime('%Y-%m-%d_%H-%M')
-                    
-                    # rebuild the file name and rename
-                    if test_mode:
-                        new_file_name = am_format + " --to-- " + site_name + '-' + time_str + '.WAV'
-                    else:
-                        new_file_name = site_name + '-' + time_str + '.WAV'
-                    
-                    src = to_dir + '\\' + item
-                    dst = to_dir + '\\' + new_file_name
-                
-                    i = 1
-                    while os.path.exists(dst):
-                        # Error -- file already exists, could be because two files are just a few seconds apart so the names, 
-                        # when rounded to the nearest minute, are the same. Create a special error name and continue.
-                        msg = 'Tried to rename ' + src + ' to ' + dst + ' but that file already exists. Trying new name.'
-                        print(msg)
-                        actions += add_action(msg)
+                    future = Future()
+                    future.set_result(stream_one_file(record, to_dir, dest_name, test_mode, mode, checksum, schedule))
+                in_flight.append((record, actions, name_actions, future))
+                files += 1
+                total_bytes += record.size
+                while len(in_flight) >= workers * STREAM_QUEUE_PER_WORKER:
+                    if not finish_next():
                         result = False
-                    
-                        new_file_name = site_name + '-' + time_str + ' RENAME ERROR ' + str(i) + '.WAV'
-                        dst = to_dir + '\\' + new_file_name    
-                        i += 1
+    finally:
+        # Whatever was already started gets finished and logged, even if the run is being stopped
+        while in_flight:
+            if not finish_next():
+                result = False
+        if pool is not None:
+            pool.shutdown()
+        progress.done()
+        copy_seconds = time.perf_counter() - start - validate_seconds - check_seconds
+        results_file.stats.add("validate", validate_seconds, files)
+        results_file.stats.add("copy", copy_seconds, files, total_bytes)
+        if schedule is not None and files > 0 and copy_seconds > 0:
+            results_file.add("Copied {0} files, {1:.1f} MB in {2:.2f} s ({3:.1f} MB/s) with {4}".format(
+                files, total_bytes / 1e6, copy_seconds, total_bytes / 1e6 / copy_seconds, schedule.describe()))
+
+    if files == 0 and result and catalogue is None:
+        msg = "Error! Source directory is empty, no files found."
+        print(msg)
+        results_file.add(msg)
+        result = False
+
+    return result
+
+
+#### How the renamed files are laid out in the new folder (--layout)
+####   flat     all in the folder itself (the default)
+####   daily    in a subfolder for each day, e.g. 2020-06-04/RRam-2020-06-04_17-30.WAV
+####   monthly  in a subfolder for each month, e.g. 2020-06/RRam-2020-06-04_17-30.WAV
+#### The day is the one in the new name, so in local time if that's what the names are in.
+LAYOUTS = ("flat", "daily", "monthly")
 
-                        actions += add_action("Trying {0}".format(dst))
 
-                    actions += add_action("Renaming: {0} > {1}".format(item, new_file_name))
+#### The subfolder a file named with time_str (from format_local_times) goes in, or None for flat
+def shard_name(time_str, layout):
+    if layout == "daily":
+        return time_str[:10]
+    if layout == "monthly":
+        return time_str[:7]
+    return None
 
-                    os.rename(src, dst)
 
-            else: 
-                # filename not valid type
-                x = os.path.split(absolute_path)[1]
-                if os.path.split(absolute_path)[1] != "amresults.txt":
-                    msg = "Error! Wrong file type, file not renamed: {0}".format(absolute_path)
+#### Make the subfolders that the new names (relative to to_dir, None = not renamed) need. Each is made once,
+#### rather than checked for every file.
+def make_shard_dirs(to_dir, new_names):
+    for shard in set(name.rpartition('/')[0] for name in new_names if name is not None and '/' in name):
+        os.makedirs(os.path.join(to_dir, shard), exist_ok=True)
+
+
+#### The name of path relative to dir_name, with forward slashes, e.g. "2020-06-04/RRam-2020-06-04_17-30.WAV"
+def relative_name(path, dir_name):
+    return os.path.relpath(path, dir_name).replace('\\', '/')
+
+
+#### Names of everything in a folder, from a single listing, for checking new names against without
+#### going back to the disk each time. Empty if the folder doesn't exist yet.
+def existing_names(dir_name):
+    try:
+        with os.scandir(dir_name) as it:
+            return set(os.path.normcase(entry.name) for entry in it)
+    except FileNotFoundError:
+        return set()
+
+
+#### Every name in use in a destination folder, for plan_new_names: what's in it, plus the new names handed
+#### out so far. normcase() so this matches the way Windows compares names. With a layout, each subfolder is
+#### listed the first time a file is going into it. --watch keeps one of these for the whole run, so the
+#### folder is only listed once however many batches there are.
+class TakenNames:
+    def __init__(self, to_dir, layout="flat"):
+        self.names = existing_names(to_dir) if layout == "flat" else set()
+        self.listed_shards = set()
+        self.next_suffix = {}    # time_str -> the next RENAME ERROR number to try for it
+
+
+#### Work out the new names for a list of records without touching any files.
+#### Returns a list with one (record, new_file_name, actions) per record, where new_file_name is None if
+#### the file can't be renamed, and True/False for whether everything could be named without a problem.
+#### The list is in recording time order, so when several files land on the same minute the earliest
+#### gets the plain name and the rest get RENAME ERROR 1, 2, ... in order.
+#### to_dir is the folder the new names will live in; src_dir is where the files are now, for the log.
+#### If a journal is given, files that an earlier run already planned a journal_op ("copy" or "rename") for
+#### keep the name it picked.
+#### layout is one of LAYOUTS; with daily or monthly the new names include the subfolder, e.g. "2020-06-04/RRam-...".
+#### taken_names is a TakenNames for to_dir, kept from an earlier call; by default to_dir is listed.
+def plan_new_names(to_dir, records, site_name, target_tz, test_mode, src_dir=None, journal=None, journal_op=None, layout="flat",
+                   taken_names=None):
+    result = True
+    plan = []
+    if taken_names is None:
+        taken_names = TakenNames(to_dir, layout)
+    taken = taken_names.names
+    listed_shards = taken_names.listed_shards
+    next_suffix = taken_names.next_suffix
+
+    if src_dir is None:
+        src_dir = to_dir
+
+    # Names an interrupted run already planned are kept, and nothing else may use them
+    planned_names = {}
+    if journal is not None:
+        for record in records:
+            dst = journal.planned_dst(journal_op, os.path.join(src_dir, record.name).replace('\\', '/'))
+            if dst is not None:
+                planned_names[record.name] = relative_name(dst, to_dir)
+                taken.add(os.path.normcase(relative_name(dst, to_dir)))
+
+    # Files we can't rename go last, in name order
+    records = sorted(records, key=lambda record: (record.timestamp is None, record.timestamp or 0, record.name))
+
+    # Convert all the times in one go; files on one card only span a few DST periods
+    time_strs = format_local_times([record.timestamp for record in records], target_tz)
+
+    for record, time_str in zip(records, time_strs):
+        actions = ""
+        new_file_name = None
+        item = record.name
+        absolute_path = os.path.join(src_dir, item).replace('\\', '/')
+
+        debug('Test and then rename ' + absolute_path)
+        if item in planned_names:
+            new_file_name = planned_names[item]
+
+        elif iswavfile(item):
+            # Split off file name. The time was already converted from hex or YYYYMMDD_HHMMSS by the scan
+            am_format = os.path.splitext(item)[0]
+
+            if time_str is None:
+                msg = "Error! Filename is not valid, file not renamed: {0}  ".format(absolute_path)
+                print(msg)
+                actions += add_action(msg)
+                result = False
+
+            else:  
+                prefix = ''
+                shard = shard_name(time_str, layout)
+                if shard is not None:
+                    prefix = shard + '/'
+                    if shard not in listed_shards:
+                        listed_shards.add(shard)
+                        taken.update(os.path.normcase(prefix + name) for name in existing_names(os.path.join(to_dir, shard)))
+
+                # rebuild the file name
+                if test_mode:
+                    new_file_name = prefix + am_format + " --to-- " + site_name + '-' + time_str + '.WAV'
+                else:
+                    new_file_name = prefix + site_name + '-' + time_str + '.WAV'
+                
+                src = os.path.join(src_dir, item)
+                dst = os.path.join(to_dir, new_file_name)
+            
+                i = next_suffix.get(time_str, 1)
+                while os.path.normcase(new_file_name) in taken:
+                    # Error -- file already exists, could be because two files are just a few seconds apart so the names, 
+                    # when rounded to the nearest minute, are the same. Create a special error name and continue.
+                    msg = 'Tried to rename ' + src + ' to ' + dst + ' but that file already exists. Trying new name.'
                     print(msg)
                     actions += add_action(msg)
                     result = False
+                
+                    new_file_name = prefix + site_name + '-' + time_str + ' RENAME ERROR ' + str(i) + '.WAV'
+                    dst = os.path.join(to_dir, new_file_name)
+                    i += 1
+
+                    actions += add_action("Trying {0}".format(dst))
+
+                next_suffix[time_str] = i
+                taken.add(os.path.normcase(new_file_name))
+
+        else: 
+            # filename not valid type
+            msg = "Error! Wrong file type, file not renamed: {0}".format(absolute_path)
+            print(msg)
+            actions += add_action(msg)
+            result = False
+
+        plan.append((record, new_file_name, actions))
+
+    return plan, result
+
+
+#### Go through a folder and rename all the files
+#### records are the files to rename (by name, already parsed); if not given, to_dir is scanned
+#### journal, if given, is the folder's Journal: files it says are already renamed are left out
+#### manifest, if given, is the Manifest for to_dir, which has its entries renamed to match
+#### catalogue, if given, is the Catalogue to add each renamed file to
+#### layout is one of LAYOUTS, for putting the renamed files in subfolders
+#### taken_names, if given, is a TakenNames for to_dir to use instead of listing it (see plan_new_names)
+def rename_files(to_dir, site_name, target_tz, test_mode, results_file, records=None, journal=None, manifest=None, catalogue=None,
+                 layout="flat", taken_names=None):
+    if records is None:
+        records = scan_folder(to_dir)
+    
+    if records:
+        if journal is not None:
+            # Leave out what an earlier run already renamed
+            todo = [record for record in records if not journal.is_done("rename", os.path.join(to_dir, record.name).replace('\\', '/'))]
+            if len(todo) < len(records):
+                results_file.add("Resuming: {0} files were already renamed, {1} left to rename".format(len(records) - len(todo), len(todo)))
+                if manifest is not None:
+                    for record in records:
+                        src = os.path.join(to_dir, record.name).replace('\\', '/')
+                        if journal.is_done("rename", src):
+                            manifest.rename(record.name, relative_name(journal.planned_dst("rename", src), to_dir))
+            records = todo
+
+        name_plan, result = plan_new_names(to_dir, records, site_name, target_tz, test_mode, journal=journal, journal_op="rename",
+                                           layout=layout, taken_names=taken_names)
+        make_shard_dirs(to_dir, [new_file_name for record, new_file_name, name_actions in name_plan])
+        if journal is not None:
+            # Write down every rename before doing any of them
+            journal.plan("rename", [(os.path.join(to_dir, record.name).replace('\\', '/'), os.path.join(to_dir, new_file_name).replace('\\', '/'))
+                                    for record, new_file_name, name_actions in name_plan if new_file_name is not None])
+
+        start = time.perf_counter()
+        progress = Progress("Renaming", len(name_plan))
+        for record, new_file_name, name_actions in name_plan:
+            results_file.write(name_actions)
+            progress.update()
+            if new_file_name is None:
+                continue
+
+            item = record.name
+            src = os.path.join(to_dir, item)
+            dst = os.path.join(to_dir, new_file_name)
+            results_file.add("Renaming: {0} > {1}".format(item, new_file_name))
+
+            file_start = time.perf_counter()
+            try:
+                os.rename(src, dst)
+                status = "ok"
+            except FileNotFoundError as why:
+                if journal is not None and os.path.exists(dst):
+                    # Renamed by the earlier run just before it stopped, it didn't get to write that down
+                    results_file.add("Already renamed: {0}".format(new_file_name))
+                    status = "ok"
+                else:
+                    msg = "Error! OS error: {0} at {1}".format(why, src.replace('\\', '/'))
+                    progress.clear()
+                    print(msg)
+                    results_file.add(msg)
+                    result = False
+                    status = "error"
+            except OSError as why:
+                # Most likely the copy of this file failed, which was already reported
+                msg = "Error! OS error: {0} at {1}".format(why, src.replace('\\', '/'))
+                progress.clear()
+                print(msg)
+                results_file.add(msg)
+                result = False
+                status = "error"
+            results_file.record("rename", src.replace('\\', '/'), dst.replace('\\', '/'), record.size, time.perf_counter() - file_start, status)
+            if status == "ok" and manifest is not None:
+                manifest.rename(item, new_file_name)
+            if status == "ok" and catalogue is not None:
+                catalogue.add(record, dst.replace('\\', '/'), manifest.digests.get(new_file_name) if manifest is not None else None)
+            if status == "ok" and journal is not None:
+                journal.done("rename", src.replace('\\', '/'), dst.replace('\\', '/'))
+        progress.done()
+        results_file.stats.add("rename", time.perf_counter() - start, len(name_plan))
 
     else:
         #there was nothing in to_dir
-        actions = add_action("Error! No files found in {0}".format(to_dir))
+        results_file.add("Error! No files found in {0}".format(to_dir))
         result = False
 
-    results_file.write(actions)
     return result
 
+
 #### Make a copy of the specified folder and rename all files in it
-def copy_and_rename_folder(from_dir, new_folder_modifier, site_name, target_tz, test_mode, results_file):
+#### records is the scan of from_dir, if the caller already has one
+#### workers is the number of files to copy at the same time, mode is one of INGEST_MODES
+#### direct=True copies each file straight to its new name instead of copying first and renaming afterwards
+#### on_problem is one of PROBLEM_POLICIES, or None to ask the user
+#### resume=True picks up where an interrupted run on this folder stopped, using its journal
+#### checksum=True works out each file's checksum as it is copied and writes them to ammanifest.b2 in the new folder
+#### stream=True goes through the folder a piece at a time with stream_folder(), instead of scanning it all first;
+#### the files are then validated as they come, using header_mode (see validate_all_files)
+#### catalog is the file name of a catalogue (see Catalogue) to skip files already ingested and add new ones to;
+#### catalog_match is one of CATALOGUE_MATCHES
+#### layout is one of LAYOUTS, for putting the renamed files in a subfolder for each day or month
+#### integrity is one of INTEGRITY_POLICIES to check the WAV headers for cut short files before copying, or None
+#### Returns True if everything worked, False if there was an error or the folder was skipped
+def copy_and_rename_folder(from_dir, new_folder_modifier, site_name, target_tz, test_mode, results_file, records=None, workers=1, mode="copy",
+                           direct=False, on_problem=None, resume=False, checksum=False, stream=False, header_mode=None, catalog=None,
+                           catalog_match="size", layout="flat", integrity=None, copy_order="listing", buffer_size=COPY_BUFFER_SIZE,
+                           bandwidth=None):
+    journal_filename = os.path.join(from_dir, "amjournal.jsonl")
+    if resume and not os.path.exists(journal_filename):
+        results_file.add("No journal from an earlier run in {0}, starting from the beginning".format(from_dir))
+        resume = False
+
+    # Test mode only makes empty files, and in place there is no copy to check
+    manifest = None
+    if checksum and mode == "inplace":
+        results_file.add("Checksums are only made when files are copied, not with mode inplace")
+    elif checksum and not test_mode:
+        manifest = Manifest(from_dir + new_folder_modifier)
+
+    # Find damaged files before any copying starts. Streaming checks each chunk as it goes.
+    if integrity is not None and not stream:
+        if records is None:
+            records = scan_folder(from_dir)
+        count = len(records)
+        records = check_integrity(records, integrity, results_file, max(workers, INTEGRITY_WORKERS))
+        if count > 0 and not records:
+            msg = "Error! Every file in {0} is damaged, nothing to copy".format(from_dir)
+            print(msg)
+            results_file.add(msg)
+            return False
+
+    catalogue = None
+    if catalog is not None:
+        catalogue = Catalogue(catalog, site_name, catalog_match, read_only=test_mode)
+        # Leave out what has already been ingested before doing anything, so a folder with nothing new doesn't
+        # even get a destination folder. Streaming checks as it goes.
+        if not stream:
+            if records is None:
+                records = scan_folder(from_dir)
+            count = len(records)
+            records = catalogue.skip_known(records, results_file)
+            if count > 0 and not records:
+                catalogue.close()
+                msg = "Everything in {0} has already been ingested".format(from_dir)
+                print(msg)
+                results_file.add(msg)
+                return True
+
+    schedule = CopySchedule(copy_order, buffer_size, bandwidth)
+    journal = Journal(journal_filename, resume)
+    try:
+        return copy_and_rename_with_journal(from_dir, new_folder_modifier, site_name, target_tz, test_mode, results_file, records,
+                                            workers, mode, direct, on_problem, resume, journal, manifest, stream, header_mode, catalogue,
+                                            layout, integrity, schedule)
+    finally:
+        journal.close()
+        if manifest is not None:
+            manifest.save(results_file)
+        if catalogue is not None:
+            catalogue.close()
+
+
+#### The work of copy_and_rename_folder, once the journal is open. taken_names, if given, is a TakenNames
+#### for the destination folder, kept from one call to the next (--watch).
+def copy_and_rename_with_journal(from_dir, new_folder_modifier, site_name, target_tz, test_mode, results_file, records, workers, mode,
+                                 direct, on_problem, resume, journal, manifest=None, stream=False, header_mode=None, catalogue=None,
+                                 layout="flat", integrity=None, schedule=None, taken_names=None):
     actions = ""
 
+    if records is None and not stream:
+        records = scan_folder(from_dir)
+
+    # In test mode we only ever make empty files in a new folder, so the originals are never touched
+    if test_mode and mode != "copy":
+        actions += add_action("Test mode, so using mode 'copy' instead of '{0}'".format(mode))
+        mode = "copy"
+    actions += add_action("Ingest mode: " + mode)
+
+    if mode == "inplace":
+        actions += add_action('Files will be renamed where they are:' + from_dir)
+        print(actions)
+        results_file.write(actions)
+        journal.start(results_file)
+        return rename_files(from_dir, site_name, target_tz, test_mode, results_file, records, journal, catalogue=catalogue)
+
     # determine directory name
     to_dir = from_dir + new_folder_modifier
     actions += add_action('Files will be saved here:' + to_dir)
     print(actions)
 
-    # If the folder already exists, then prompt how to continue
-    if os.path.exists(to_dir):
+    # If the folder already exists, then prompt how to continue. When resuming it's expected to be there.
+    if resume and os.path.exists(to_dir):
+        actions += add_action("Resuming into folder: " + to_dir)
+    elif os.path.exists(to_dir):
         print("The destination folder {0} already exists! Copy files from the source folder into it and rename everything? ".format(to_dir))
-        choice = input('s = Skip to next folder, c = Continue copying this folder ')
-        if  choice.lower() == 's':
+        choice = ask_user('s = Skip to next folder, c = Continue copying this folder ', on_problem)
+        if choice == 'a':
+            results_file.write(actions)
+            raise AbortRun("The destination folder {0} already exists".format(to_dir))
+        if  choice == 's':
             actions += add_action("Skipping folder:" + to_dir)
             results_file.write(actions)
-            return
+            return False
         #Anything besides 's' will just continue copying
     else:
         actions += add_action("Making folder: " + to_dir)
         os.mkdir(to_dir)
 
     results_file.write(actions)
+    # The folder is being done, so the journal can be started
+    journal.start(results_file)
+
+    if stream:
+        return stream_folder(from_dir, to_dir, site_name, target_tz, test_mode, results_file, workers, mode, on_problem, header_mode,
+                             manifest, catalogue, layout, integrity, schedule)
+
+    if direct:
+        # Work out every new name first, then copy each file straight to it. No second pass over to_dir.
+        name_plan, result = plan_new_names(to_dir, records, site_name, target_tz, test_mode, src_dir=from_dir, journal=journal, journal_op="copy",
+                                           layout=layout, taken_names=taken_names)
+        make_shard_dirs(to_dir, [new_file_name for record, new_file_name, name_actions in name_plan])
+        records = []
+        dest_names = []
+        for record, new_file_name, name_actions in name_plan:
+            results_file.write(name_actions)
+            records.append(record)
+            dest_names.append(new_file_name)
+        if copy_files_to_new_dir(from_dir, to_dir, test_mode, results_file, records, workers, mode, dest_names, journal, manifest,
+                                 catalogue, schedule) == False:
+            print("An error occurred, see above!")
+            result = False
+        return result
 
     # copy files to new directory
-    if copy_files_to_new_dir(from_dir, to_dir, test_mode, results_file) == False:
-        if input("An error occurred, see above! s = Stop now, c = Attempt to rename files: ").lower() == "s":
-            return
+    if copy_files_to_new_dir(from_dir, to_dir, test_mode, results_file, records, workers, mode, journal=journal, manifest=manifest,
+                             schedule=schedule) == False:
+        choice = ask_user("An error occurred, see above! s = Stop now, c = Attempt to rename files: ", on_problem)
+        if choice == 'a':
+            raise AbortRun("Error copying files from {0}".format(from_dir))
+        if choice == "s":
+            return False
+        rename_files(to_dir, site_name, target_tz, test_mode, results_file, records, journal, manifest, catalogue, layout, taken_names)
+        return False
 
-    # go through the new directory and rename files
-    rename_files(to_dir, site_name, target_tz, test_mode, results_file)
+    # go through the new directory and rename the files we just copied, reusing the times parsed by the scan
+    return rename_files(to_dir, site_name, target_tz, test_mode, results_file, records, journal, manifest, catalogue, layout, taken_names)
 
 
 #### Validate that the file is a .WAV file
@@ -253,22 +1570,632 @@ def ishexfile(filename):
     return(ishex(name))
 
 
-def validate_all_files(files, results_file):
-    for filename in files:
-        if filename != "amresults.txt":
+#### records is the output of scan_folder, on_problem is one of PROBLEM_POLICIES or None to ask the user
+#### header_mode is one of HEADER_MODES to take times from the WAV headers first, or None to only use the names
+#### Returns True to go ahead with the folder, False if it should be skipped. Raises AbortRun to stop everything.
+def validate_all_files(records, results_file, on_problem=None, header_mode=None):
+    if header_mode is not None:
+        apply_header_times(records, header_mode, results_file)
+
+    for record in records:
+        if not record.valid:
+            filename = record.name
             if iswavfile(filename) == False: 
-                if input('Folder contains %s, which is not a WAV file! a=abort, c=continue ' % filename).lower() == 'a':
-                    exit_app(results_file, 1)
+                choice = ask_user('Folder contains %s, which is not a WAV file! a=abort, c=continue ' % filename, on_problem)
+                if choice == 'a':
+                    raise AbortRun('Folder contains %s, which is not a WAV file' % filename)
+                if choice == 's':
+                    return False
         
-            if not ishexfile(filename) and not is_valid_filename(filename):
+            if record.timestamp is None:
                 msg = 'Folder contains {0}, which is neither a hex-named file nor a valid date-named file! a=abort, c=continue '.format(filename)
-                if input(msg).lower() == 'a':
-                    exit_app(results_file, 1)
+                choice = ask_user(msg, on_problem)
+                if choice == 'a':
+                    raise AbortRun('Folder contains {0}, which is neither a hex-named file nor a valid date-named file'.format(filename))
+                if choice == 's':
+                    return False
+
+    return True
 
 
 def add_action(message):
     return message + "\n"
 
+
+#### Write-ahead journal of the copies and renames done in one folder, kept in amjournal.jsonl next to
+#### amresults.txt. Each copy or rename is written down as "planned" before any of them start, and as
+#### "done" once it has happened, so an interrupted run can be picked up with --resume and only do
+#### what's left. op is "copy" (for any of the INGEST_MODES) or "rename"; files are known by their
+#### source path. Paths are written relative to the journal's folder, so it doesn't matter how the
+#### folder was named on the command line, or if it has been moved since.
+#### Nothing is written until start(), which is called once it's certain the folder is being done, so a
+#### run that stops at a question doesn't wipe out the journal of an earlier one.
+class Journal:
+    def __init__(self, filename, resume=False, flush_lines=100, flush_seconds=2.0):
+        self.filename = filename
+        self.dir_name = os.path.dirname(os.path.abspath(filename))
+        self.append = resume and os.path.exists(filename)
+        self.file = None
+        self.planned = {}       # (op, src key) -> dst, relative to dir_name
+        self.completed = set()  # (op, src key)
+        self.digests = {}       # (op, src key) -> checksum, for copies made with --checksum
+        if self.append:
+            self.planned, self.completed, self.digests = read_journal(filename)
+        self.flush_lines = flush_lines
+        self.flush_seconds = flush_seconds
+        self.buffer = []
+        self.last_flush = time.monotonic()
+
+    #### path, relative to the journal's folder, as written in the journal
+    def relative(self, path):
+        return os.path.relpath(path, self.dir_name).replace('\\', '/')
+
+    #### What src is known by in the journal. normcase() so this matches the way Windows compares names.
+    def key(self, path):
+        return os.path.normcase(self.relative(path)).replace('\\', '/')
+
+    #### Open the file to write to. Without resume, the journal of an earlier run that didn't finish is
+    #### kept as PREVIOUS_JOURNAL_FILE rather than being written over.
+    def start(self, results_file):
+        if self.file is not None:
+            return
+        if not self.append and os.path.exists(self.filename):
+            planned, completed, digests = read_journal(self.filename)
+            if set(planned) - completed:
+                previous = os.path.join(self.dir_name, PREVIOUS_JOURNAL_FILE)
+                os.replace(self.filename, previous)
+                results_file.add("The journal of an earlier run that didn't finish was kept as " + previous.replace('\\', '/'))
+        self.file = open(self.filename, "a" if self.append else "w")
+
+    def is_done(self, op, src):
+        return (op, self.key(src)) in self.completed
+
+    #### Where an earlier run planned to put src, or None
+    def planned_dst(self, op, src):
+        dst = self.planned.get((op, self.key(src)))
+        if dst is None:
+            return None
+        return os.path.join(self.dir_name, dst).replace('\\', '/')
+
+    #### The checksum written down when src was done, or None
+    def digest(self, op, src):
+        return self.digests.get((op, self.key(src)))
+
+    #### Write down a batch of (src, dst) that are about to be done. This goes to disk before returning.
+    def plan(self, op, entries):
+        for src, dst in entries:
+            key = self.key(src)
+            dst = self.relative(dst)
+            if self.planned.get((op, key)) != dst:
+                self.planned[(op, key)] = dst
+                self.buffer.append(json.dumps({"event": "planned", "op": op, "src": self.relative(src), "dst": dst}) + "\n")
+        self.flush()
+        os.fsync(self.file.fileno())
+
+    #### Write down that src has been done. These are buffered: if the run stops before they are written
+    #### the file just gets done again, which is harmless for a copy and is spotted for a rename.
+    def done(self, op, src, dst, digest=None):
+        key = self.key(src)
+        self.completed.add((op, key))
+        entry = {"event": "done", "op": op, "src": self.relative(src), "dst": self.relative(dst)}
+        if digest is not None:
+            self.digests[(op, key)] = digest
+            entry["digest"] = digest
+        self.buffer.append(json.dumps(entry) + "\n")
+        if len(self.buffer) >= self.flush_lines or time.monotonic() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        if self.file is None:
+            return
+        if self.buffer:
+            self.file.write("".join(self.buffer))
+            self.buffer = []
+        self.file.flush()
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+
+
+# Where the journal of an unfinished run goes if a new run is started on the folder without --resume
+PREVIOUS_JOURNAL_FILE = "amjournal.previous.jsonl"
+
+
+#### Read a journal file: what it planned ((op, src key) -> dst), what it finished and the checksums it has
+def read_journal(filename):
+    planned = {}
+    completed = set()
+    digests = {}
+    with open(filename) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Most likely the last line, cut off when the run stopped
+                continue
+            key = (entry["op"], os.path.normcase(entry["src"]).replace('\\', '/'))
+            if entry["event"] == "planned":
+                planned[key] = entry["dst"]
+            else:
+                completed.add(key)
+                if "digest" in entry:
+                    digests[key] = entry["digest"]
+    return planned, completed, digests
+
+
+#### The catalogue (--catalog): an SQLite database of every recording that has been ingested, by site and
+#### recording time (UTC), so a card offloaded twice, or overlapping folders, don't get copied again as
+#### RENAME ERROR duplicates. One catalogue can be shared by any number of runs, folders and sites.
+#### What counts as the same recording is set by match, one of CATALOGUE_MATCHES:
+####   time  same site and recording time
+####   size  ... and the same size (the default)
+####   hash  ... and the same checksum, if the catalogue has one (made with --checksum). Only files that
+####         already match on time and size are read to check this.
+CATALOGUE_MATCHES = ("time", "size", "hash")
+
+# How many new rows to save up before writing them
+CATALOGUE_COMMIT_ROWS = 500
+
+# How many times to try writing them if another process has the catalogue locked for too long, and how
+# long to wait before the first retry (it doubles each time)
+CATALOGUE_WRITE_TRIES = 4
+CATALOGUE_RETRY_SECONDS = 1.0
+
+
+class Catalogue:
+    def __init__(self, filename, site_name, match="size", read_only=False):
+        self.site_name = site_name
+        self.match = match
+        self.read_only = read_only    # e.g. test mode: look things up but don't add anything
+        self.rows = []                # new rows, not written yet
+        # Several processes (--jobs) may use the same catalogue. New rows are saved up here and written in one
+        # short transaction, so no process holds the write lock while it copies; WAL lets the others read
+        # meanwhile. isolation_level=None so sqlite3 doesn't start transactions of its own.
+        self.db = sqlite3.connect(filename, timeout=60, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # The primary key is the index every lookup uses, so they stay quick however big this gets
+        self.db.execute("""CREATE TABLE IF NOT EXISTS recordings (
+                               site TEXT NOT NULL,
+                               recorded INTEGER NOT NULL,
+                               size INTEGER NOT NULL,
+                               digest TEXT,
+                               source TEXT NOT NULL,
+                               path TEXT NOT NULL,
+                               ingested TEXT NOT NULL,
+                               PRIMARY KEY (site, recorded, size)
+                           ) WITHOUT ROWID""")
+
+    #### Where an earlier run put this recording, or None if it hasn't been ingested
+    def find(self, record):
+        if record.timestamp is None:
+            return None
+        rows = self.db.execute("SELECT size, digest, path FROM recordings WHERE site = ? AND recorded = ?",
+                               (self.site_name, record.timestamp)).fetchall()
+        digest = None
+        for size, known_digest, path in rows:
+            if self.match == "time":
+                return path
+            if size != record.size:
+                continue
+            if self.match == "hash" and known_digest is not None:
+                if digest is None:
+                    digest = hash_file(record.path)
+                if digest != known_digest:
+                    continue
+            return path
+        return None
+
+    #### The records that haven't been ingested yet. The rest are reported and left out.
+    def skip_known(self, records, results_file):
+        new_records = []
+        for record in records:
+            path = self.find(record)
+            if path is None:
+                new_records.append(record)
+            else:
+                results_file.add("Already ingested, skipping: {0} (as {1})".format(record.path, path))
+        if len(new_records) < len(records):
+            msg = "Skipped {0} files that were already ingested".format(len(records) - len(new_records))
+            print(msg)
+            results_file.add(msg)
+        return new_records
+
+    #### Write down that record has been ingested as path. digest is its checksum, if there is one.
+    #### Paths are stored in full, as runs can be started from anywhere.
+    def add(self, record, path, digest=None):
+        if self.read_only or record.timestamp is None:
+            return
+        self.rows.append((self.site_name, record.timestamp, record.size, digest,
+                          os.path.abspath(record.path).replace('\\', '/'), os.path.abspath(path).replace('\\', '/'),
+                          datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        if len(self.rows) >= CATALOGUE_COMMIT_ROWS:
+            self.commit()
+
+    #### Write the new rows to the catalogue. If another process keeps it locked, try again a few times; if
+    #### it still can't be written, say so and keep the rows to try again next time. Returns True if written.
+    def commit(self):
+        if not self.rows:
+            return True
+        wait = CATALOGUE_RETRY_SECONDS
+        for attempt in range(CATALOGUE_WRITE_TRIES):
+            try:
+                self.db.execute("BEGIN IMMEDIATE")
+                try:
+                    self.db.executemany("INSERT OR REPLACE INTO recordings (site, recorded, size, digest, source, path, ingested) "
+                                        "VALUES (?, ?, ?, ?, ?, ?, ?)", self.rows)
+                    self.db.execute("COMMIT")
+                except BaseException:
+                    self.db.execute("ROLLBACK")
+                    raise
+                self.rows = []
+                return True
+            except sqlite3.OperationalError as why:
+                if attempt + 1 == CATALOGUE_WRITE_TRIES:
+                    print("Error! Couldn't add {0} recordings to the catalogue: {1}".format(len(self.rows), why))
+                    return False
+                time.sleep(wait)
+                wait *= 2
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+#### What to do about a problem when there's nobody to ask (--on-problem)
+####   continue  carry on anyway, as if the user typed c
+####   skip      leave out the folder with the problem and go on to the next one
+####   abort     stop the whole run
+PROBLEM_POLICIES = ("continue", "skip", "abort")
+
+
+#### Raised to stop the whole run, when the user or the on_problem policy says to abort
+class AbortRun(Exception):
+    pass
+
+
+#### Ask the user a question and return the answer in lower case. If there is a policy, don't ask,
+#### just show what was decided and answer with the policy's first letter (c, s or a).
+def ask_user(prompt, policy=None):
+    if policy is None:
+        return input(prompt).lower()
+    print(prompt + policy)
+    return policy[0]
+
+
+#### Phase timings and totals for a run: how long scan, validate, copy and rename took and how many
+#### files and bytes each got through. Every ResultsLog has one; the summary goes at the end of the report.
+class RunStats:
+    PHASES = ("scan", "validate", "copy", "rename")
+
+    def __init__(self):
+        self.phases = {}    # phase -> [seconds, files, bytes]
+        self.folders = 0    # folders done with execute()
+
+    def add(self, phase, seconds, files=0, size=0):
+        totals = self.phases.setdefault(phase, [0.0, 0, 0])
+        totals[0] += seconds
+        totals[1] += files
+        totals[2] += size
+
+    #### Add in the stats of another run, e.g. a folder done in a worker process
+    def merge(self, other):
+        for phase, (seconds, files, size) in other.phases.items():
+            self.add(phase, seconds, files, size)
+        self.folders += other.folders
+
+    #### A copy of the totals so far, to pass to summary(since=...) later
+    def snapshot(self):
+        return {phase: list(totals) for phase, totals in self.phases.items()}
+
+    #### The summary lines for the report. since is a snapshot(), to only count what happened after it.
+    def summary(self, title, since=None):
+        lines = title + "\n"
+        for phase in [phase for phase in self.PHASES if phase in self.phases] + sorted(set(self.phases) - set(self.PHASES)):
+            seconds, files, size = self.phases[phase]
+            if since is not None and phase in since:
+                seconds, files, size = seconds - since[phase][0], files - since[phase][1], size - since[phase][2]
+            line = "   {0}: {1} files".format(phase, files)
+            if size:
+                line += ", {0:.1f} MB".format(size / 1e6)
+            line += " in {0:.2f} s".format(seconds)
+            if seconds > 0:
+                line += " ({0:.0f} files/s".format(files / seconds)
+                if size:
+                    line += ", {0:.1f} MB/s".format(size / 1e6 / seconds)
+                line += ")"
+            lines += line + "\n"
+        return lines
+
+
+#### How long something will take to finish, e.g. "0:01:23"
+def format_duration(seconds):
+    seconds = int(seconds)
+    return "{0}:{1:02d}:{2:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+#### The live "Copying: 120/3000 files ..." line, redrawn at most every interval seconds. Only shown when
+#### the output is a terminal, so a log of the output doesn't fill up with it. total_files is None if it
+#### isn't known, and then there is no ETA.
+class Progress:
+    def __init__(self, label, total_files, total_bytes=0, interval=0.5):
+        self.label = label
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.files = 0
+        self.bytes = 0
+        self.start = time.perf_counter()
+        self.last_shown = 0.0
+        self.shown = False
+        self.enabled = sys.stdout.isatty()
+
+    def update(self, size=0):
+        self.files += 1
+        self.bytes += size
+        if self.enabled and (time.perf_counter() - self.last_shown >= self.interval or self.files == self.total_files):
+            self.show()
+
+    def show(self):
+        now = time.perf_counter()
+        elapsed = now - self.start
+        if self.total_files is None:
+            # Streaming, so we don't know how many there will be
+            line = "{0}: {1} files, {2:.1f} MB".format(self.label, self.files, self.bytes / 1e6)
+        else:
+            line = "{0}: {1}/{2} files".format(self.label, self.files, self.total_files)
+            if self.total_bytes:
+                line += ", {0:.1f}/{1:.1f} MB".format(self.bytes / 1e6, self.total_bytes / 1e6)
+        if elapsed > 0:
+            line += ", {0:.0f} files/s".format(self.files / elapsed)
+            if self.total_bytes or self.total_files is None:
+                line += ", {0:.1f} MB/s".format(self.bytes / 1e6 / elapsed)
+        # Go by bytes if we know them, as one big file takes longer than one small one
+        if self.total_files is None:
+            pass
+        elif self.total_bytes and self.bytes:
+            line += ", ETA " + format_duration(elapsed * (self.total_bytes - self.bytes) / self.bytes)
+        elif self.files:
+            line += ", ETA " + format_duration(elapsed * (self.total_files - self.files) / self.files)
+        sys.stdout.write("\r" + line.ljust(79))
+        sys.stdout.flush()
+        self.last_shown = now
+        self.shown = True
+
+    #### Take the line off the screen, e.g. to print an error
+    def clear(self):
+        if self.shown:
+            sys.stdout.write("\r" + " " * 79 + "\r")
+            sys.stdout.flush()
+            self.shown = False
+
+    def done(self):
+        if self.shown:
+            sys.stdout.write("\n")
+            sys.stdout.flush()
+            self.shown = False
+
+
+#### The amresults.txt report. Text is buffered and written out every flush_lines writes or flush_seconds,
+#### whichever comes first, so a big run doesn't build the whole report in memory and most of it is
+#### already on disk if the run dies partway through.
+#### If jsonl_filename is given, there is also one JSON line per file (src, dst, bytes, duration, status)
+#### for other tools to read.
+#### append=True adds to the end of the files instead of starting them again, for --resume.
+class ResultsLog:
+    def __init__(self, filename, jsonl_filename=None, flush_lines=200, flush_seconds=2.0, append=False):
+        self.stats = RunStats()
+        self.file = open(filename, "a+" if append else "w+")
+        self.jsonl_file = open(jsonl_filename, "a" if append else "w") if jsonl_filename else None
+        self.flush_lines = flush_lines
+        self.flush_seconds = flush_seconds
+        self.text_buffer = []
+        self.jsonl_buffer = []
+        self.last_flush = time.monotonic()
+
+    #### Same as file.write(), so a ResultsLog can be used anywhere the report file was
+    def write(self, text):
+        if text:
+            self.text_buffer.append(text)
+            self.flush_if_due()
+
+    def add(self, message):
+        self.write(add_action(message))
+
+    #### One line of the JSONL log. op is what was done (copy, hardlink, reflink, rename...), status is
+    #### "ok" or "error", duration is in seconds. digest is the BLAKE2b checksum of the copy, if one was made.
+    def record(self, op, src, dst, size, duration, status, digest=None):
+        if self.jsonl_file is not None:
+            entry = {"op": op, "src": src, "dst": dst, "bytes": size, "duration": round(duration, 6), "status": status}
+            if digest is not None:
+                entry["blake2b"] = digest
+            self.jsonl_buffer.append(json.dumps(entry) + "\n")
+            self.flush_if_due()
+
+    def flush_if_due(self):
+        if len(self.text_buffer) + len(self.jsonl_buffer) >= self.flush_lines or time.monotonic() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        if self.text_buffer:
+            self.file.write("".join(self.text_buffer))
+            self.text_buffer = []
+        self.file.flush()
+        if self.jsonl_file is not None:
+            if self.jsonl_buffer:
+                self.jsonl_file.write("".join(self.jsonl_buffer))
+                self.jsonl_buffer = []
+            self.jsonl_file.flush()
+        self.last_flush = time.monotonic()
+
+    #### Copy the whole of another report (e.g. one written by a worker process) onto the end of this one.
+    #### Its JSONL log, if there is one, is added to ours the same way.
+    def append_file(self, filename, jsonl_filename=None):
+        self.flush()
+        with open(filename) as section:
+            shutil.copyfileobj(section, self.file)
+        self.file.flush()
+        if self.jsonl_file is not None and jsonl_filename is not None and os.path.exists(jsonl_filename):
+            with open(jsonl_filename) as section:
+                shutil.copyfileobj(section, self.jsonl_file)
+            self.jsonl_file.flush()
+
+    #### Close the report. If it covers more (or less) than one execute() folder, which already wrote its own
+    #### summary, the totals for the whole run go at the end.
+    def close(self):
+        if self.stats.phases and self.stats.folders != 1:
+            self.write("\n" + self.stats.summary("Run summary:"))
+        self.flush()
+        self.file.close()
+        if self.jsonl_file is not None:
+            self.jsonl_file.close()
+
+#### Everything needed to copy and rename one folder. Made by plan() and carried out by execute().
+class Plan:
+    def __init__(self, from_dir, new_folder_modifier, site_name, target_tz, records, test_mode=False, mode="copy", workers=1,
+                 direct=False, on_problem="abort", write_jsonl=False, resume=False, header_mode=None, checksum=False, stream=False,
+                 catalog=None, catalog_match="size", layout="flat", integrity=None, copy_order="listing", buffer_size=COPY_BUFFER_SIZE,
+                 bandwidth=None):
+        self.from_dir = from_dir
+        self.new_folder_modifier = new_folder_modifier
+        self.site_name = site_name
+        self.target_tz = target_tz
+        self.records = records
+        self.test_mode = test_mode
+        self.mode = mode
+        self.workers = workers
+        self.direct = direct
+        self.on_problem = on_problem
+        self.write_jsonl = write_jsonl
+        self.resume = resume
+        self.header_mode = header_mode
+        self.checksum = checksum
+        self.stream = stream
+        self.catalog = catalog
+        self.catalog_match = catalog_match
+        self.layout = layout
+        self.integrity = integrity
+        self.copy_order = copy_order
+        self.buffer_size = buffer_size
+        self.bandwidth = bandwidth
+        self.scan_seconds = None    # how long scanning from_dir for records took, if it was timed
+
+    #### Where the renamed files will end up
+    def to_dir(self):
+        if self.mode == "inplace":
+            return self.from_dir
+        return self.from_dir + self.new_folder_modifier
+
+
+#### Scan a folder and work out what to do with it, without asking anything or changing any files.
+#### This, with execute(), is the way to use this script from other Python code, e.g.
+####     import AMRename
+####     for folder in folders:
+####         AMRename.execute(AMRename.plan(folder, "RRam", "America/Los_Angeles", on_problem="skip"))
+#### site_name is used as-is at the start of the new names. tz is a time zone name or pytz zone; UTC keeps UTC times.
+#### Raises ValueError if an option doesn't make sense.
+#### resume=True only does what an interrupted run on this folder didn't finish.
+#### header is one of HEADER_MODES to also get recording times from the WAV headers.
+#### checksum=True writes a manifest of checksums to the new folder; verify_archive() checks it later.
+#### stream=True doesn't scan the folder here, but a piece at a time while copying (see stream_folder).
+#### catalog is an SQLite file of what has been ingested, to skip recordings already done; catalog_match is
+#### one of CATALOGUE_MATCHES.
+#### layout is one of LAYOUTS, to put the new files in a subfolder for each day or month.
+#### integrity is one of INTEGRITY_POLICIES, to check for WAV files that were cut short before copying.
+#### order is one of COPY_ORDERS, buffer_size the most bytes read at a time when copying, and bandwidth the most
+#### bytes a second to copy (None for no limit).
+def plan(source, site_name, tz="UTC", test_mode=False, mode="copy", workers=1, direct=False, on_problem="abort", jsonl=False,
+         resume=False, header=None, checksum=False, stream=False, catalog=None, catalog_match="size", layout="flat", integrity=None,
+         order="listing", buffer_size=COPY_BUFFER_SIZE, bandwidth=None):
+    if not os.path.isdir(source):
+        raise ValueError("Directory {0} does not exist".format(source))
+    if mode not in INGEST_MODES:
+        raise ValueError("mode must be one of: " + ", ".join(INGEST_MODES))
+    if on_problem not in PROBLEM_POLICIES:
+        raise ValueError("on_problem must be one of: " + ", ".join(PROBLEM_POLICIES))
+    if workers < 1:
+        raise ValueError("workers must be at least 1")
+    if header is not None and header not in HEADER_MODES:
+        raise ValueError("header must be one of: " + ", ".join(HEADER_MODES))
+    if stream and (resume or mode == "inplace"):
+        raise ValueError("stream can't be used with resume or mode inplace")
+    if catalog_match not in CATALOGUE_MATCHES:
+        raise ValueError("catalog_match must be one of: " + ", ".join(CATALOGUE_MATCHES))
+    if layout not in LAYOUTS:
+        raise ValueError("layout must be one of: " + ", ".join(LAYOUTS))
+    if layout != "flat" and mode == "inplace":
+        raise ValueError("layout can't be used with mode inplace")
+    if integrity is not None and integrity not in INTEGRITY_POLICIES:
+        raise ValueError("integrity must be one of: " + ", ".join(INTEGRITY_POLICIES))
+    if order not in COPY_ORDERS:
+        raise ValueError("order must be one of: " + ", ".join(COPY_ORDERS))
+    if order != "listing" and stream:
+        raise ValueError("order can't be used with stream")
+    if buffer_size < 1:
+        raise ValueError("buffer_size must be at least 1")
+    if bandwidth is not None and bandwidth <= 0:
+        raise ValueError("bandwidth must be more than 0")
+
+    target_tz = timezone(tz) if isinstance(tz, str) else tz
+    if target_tz.zone == pytz.utc.zone:
+        new_folder_modifier = "_" + datetime.now(target_tz).tzname()
+    else:
+        new_folder_modifier = "_LT"
+
+    if stream:
+        return Plan(source, new_folder_modifier, site_name, target_tz, None, test_mode, mode, workers,
+                    direct, on_problem, jsonl, resume, header, checksum, stream, catalog, catalog_match, layout, integrity,
+                    order, buffer_size, bandwidth)
+
+    start = time.perf_counter()
+    records = scan_folder(source)
+    scan_seconds = time.perf_counter() - start
+    result = Plan(source, new_folder_modifier, site_name, target_tz, records, test_mode, mode, workers,
+                  direct, on_problem, jsonl, resume, header, checksum, stream, catalog, catalog_match, layout, integrity,
+                  order, buffer_size, bandwidth)
+    result.scan_seconds = scan_seconds
+    return result
+
+
+#### Carry out a Plan. Returns True if everything worked, False if there were errors or the folder was skipped.
+#### Raises AbortRun if the plan's on_problem is "abort" and there was a problem.
+#### The report goes to amresults.txt in the source folder, unless results_file (a ResultsLog) is passed in.
+#### validate=False skips checking the files, for when the caller has already done it.
+def execute(plan, results_file=None, validate=True):
+    own_results_file = results_file is None
+    if own_results_file:
+        results_file = ResultsLog(plan.from_dir + "/amresults.txt", plan.from_dir + "/amresults.jsonl" if plan.write_jsonl else None,
+                                  append=plan.resume)
+        results_file.write("Started at " + datetime.now().strftime("%m/%d/%Y, %H:%M:%S") + "\n\n")
+
+    stats = results_file.stats
+    before = stats.snapshot()
+    stats.folders += 1
+    if plan.scan_seconds is not None:
+        stats.add("scan", plan.scan_seconds, len(plan.records))
+    try:
+        # When streaming the files are validated as they are read
+        if validate and not plan.stream:
+            start = time.perf_counter()
+            valid = validate_all_files(plan.records, results_file, plan.on_problem, plan.header_mode)
+            stats.add("validate", time.perf_counter() - start, len(plan.records))
+            if not valid:
+                results_file.add("Skipping folder:" + plan.from_dir)
+                return False
+        return copy_and_rename_folder(plan.from_dir, plan.new_folder_modifier, plan.site_name, plan.target_tz, plan.test_mode,
+                                      results_file, plan.records, plan.workers, plan.mode, plan.direct, plan.on_problem, plan.resume,
+                                      plan.checksum, plan.stream, plan.header_mode, plan.catalog, plan.catalog_match, plan.layout,
+                                      plan.integrity, plan.copy_order, plan.buffer_size, plan.bandwidth)
+    finally:
+        summary = stats.summary("Summary for {0}:".format(plan.from_dir), before)
+        print(summary)
+        results_file.write("\n" + summary)
+        if own_results_file:
+            results_file.close()
+
+
 #### Ask the user for their time zone and return it. Return False if they want a TZ we don't offer.
 def getUserTimezone():
     timezone_dict = {"Eastern":"America/New_York",
@@ -304,7 +2231,9 @@ def getUserTimezone():
     return local_tz
 
 def exit_app(results_file, code):
-    results_file.close()
+    # results_file is None if we exit before it has been opened, e.g. because of bad arguments
+    if results_file is not None:
+        results_file.close()
     sys.exit(code)
 
 
@@ -324,23 +2253,49 @@ def main(argv):
     UTC_time = '_utc'
     new_folder_modifier = '_'
     site_name = '' 
+    results_file = None
 
     # Parse the command line to decide what to do
     # First, check that we don't have too many or the wrong options
     try:
-        opts, args = getopt.getopt(argv,"thulaf:s:",["fdir="])
+        opts, args = getopt.getopt(argv,"thulayf:s:",["fdir=", "workers=", "mode=", "direct", "jsonl", "yes", "non-interactive",
+                                                     "on-problem=", "tz=", "resume", "jobs=", "header=", "checksum", "verify=", "watch=", "profile=", "stream", "catalog=", "catalog-match=", "layout=", "integrity=", "order=", "buffer=",
+                                                     "bwlimit="])
     except getopt.GetoptError:
         print('Error! Wrong arguments were entered')
         print_usage_message()
         exit_app(results_file, 2)
     
-    if len(argv) > 7:
+    # Anything left over after the options is something we don't understand
+    if len(args) > 0:
         print('Error! Too many arguments were entered')
         print_usage_message()
         exit_app(results_file, 3)
     
     # Options appear to be valid, so parse them	
     test_mode = False
+    workers = 1
+    mode = "copy"
+    direct = False
+    write_jsonl = False
+    interactive = True
+    on_problem = None
+    tz_name = ''
+    resume = False
+    jobs = 1
+    header_mode = None
+    checksum = False
+    verify_dir = ''
+    watch = False
+    profile_file = ''
+    stream = False
+    catalog = None
+    catalog_match = "size"
+    layout = "flat"
+    integrity = None
+    copy_order = "listing"
+    buffer_size = COPY_BUFFER_SIZE
+    bandwidth = None
 
     #####TODO: Make sure that when we add to the action message, it happens regardless of whether the instruction
     #####      was typed by the user or came in on the command line!
@@ -369,10 +2324,196 @@ def main(argv):
         elif opt == '-t':
             test_mode = True
             action_msg += add_action("Don\'t copy actual files, just make empty ones with the same name, and rename using both before and after names.")
+        elif opt == '--workers':
+            try:
+                workers = int(arg)
+            except ValueError:
+                workers = 0
+            if workers < 1:
+                print('Error! --workers must be a whole number of at least 1')
+                print_usage_message()
+                exit_app(results_file, 2)
+            action_msg += add_action("Copy {0} files at a time.".format(workers))
+        elif opt == '--mode':
+            mode = arg.lower()
+            if mode not in INGEST_MODES:
+                print('Error! --mode must be one of: ' + ', '.join(INGEST_MODES))
+                print_usage_message()
+                exit_app(results_file, 2)
+            action_msg += add_action("Ingest mode: " + mode)
+        elif opt == '--direct':
+            direct = True
+            action_msg += add_action("Copy files straight to their new names.")
+        elif opt == '--jsonl':
+            write_jsonl = True
+            action_msg += add_action("Write a JSON line for every file to amresults.jsonl.")
+        elif opt in ('-y', '--yes', '--non-interactive'):
+            interactive = False
+        elif opt == '--on-problem':
+            on_problem = arg.lower()
+            if on_problem not in PROBLEM_POLICIES:
+                print('Error! --on-problem must be one of: ' + ', '.join(PROBLEM_POLICIES))
+                print_usage_message()
+                exit_app(results_file, 2)
+            action_msg += add_action("If there is a problem: " + on_problem)
+        elif opt == '--jobs':
+            try:
+                jobs = int(arg)
+            except ValueError:
+                jobs = 0
+            if jobs < 1:
+                print('Error! --jobs must be a whole number of at least 1')
+                print_usage_message()
+                exit_app(results_file, 2)
+            action_msg += add_action("Do {0} folders at a time.".format(jobs))
+        elif opt == '--header':
+            header_mode = arg.lower()
+            if header_mode not in HEADER_MODES:
+                print('Error! --header must be one of: ' + ', '.join(HEADER_MODES))
+                print_usage_message()
+                exit_app(results_file, 2)
+            action_msg += add_action("Read recording times from the WAV headers: " + header_mode)
+        elif opt == '--checksum':
+            checksum = True
+            action_msg += add_action("Make a checksum of every file as it is copied and write them to ammanifest.b2.")
+        elif opt == '--verify':
+            verify_dir = arg
+        elif opt == '--watch':
+            from_dir = arg
+            watch = True
+            action_msg += add_action('Watch the folder for new recordings: ' + os.path.abspath(from_dir))
+        elif opt == '--stream':
+            stream = True
+            action_msg += add_action("Copy files as the folder is read, straight to their new names.")
+        elif opt == '--catalog':
+            catalog = arg
+            action_msg += add_action("Skip recordings already in the catalogue, and add new ones to it: " + os.path.abspath(catalog))
+        elif opt == '--catalog-match':
+            catalog_match = arg.lower()
+            if catalog_match not in CATALOGUE_MATCHES:
+                print('Error! --catalog-match must be one of: ' + ', '.join(CATALOGUE_MATCHES))
+                print_usage_message()
+                exit_app(results_file, 2)
+            action_msg += add_action("Recordings are the same if they match on: " + catalog_match)
+        elif opt == '--layout':
+            layout = arg.lower()
+            if layout not in LAYOUTS:
+                print('Error! --layout must be one of: ' + ', '.join(LAYOUTS))
+                print_usage_message()
+                exit_app(results_file, 2)
+            action_msg += add_action("Put the renamed files in folders: " + layout)
+        elif opt == '--integrity':
+            integrity = arg.lower()
+            if integrity not in INTEGRITY_POLICIES:
+                print('Error! --integrity must be one of: ' + ', '.join(INTEGRITY_POLICIES))
+                print_usage_message()
+                exit_app(results_file, 2)
+            action_msg += add_action("Check WAV files for damage before copying, and: " + integrity)
+        elif opt == '--order':
+            copy_order = arg.lower()
+            if copy_order not in COPY_ORDERS:
+                print('Error! --order must be one of: ' + ', '.join(COPY_ORDERS))
+                print_usage_message()
+                exit_app(results_file, 2)
+            action_msg += add_action("Copy files in this order: " + copy_order)
+        elif opt == '--buffer':
+            try:
+                buffer_size = int(float(arg) * 1024 * 1024)
+            except ValueError:
+                buffer_size = 0
+            if buffer_size < 1:
+                print('Error! --buffer must be a number of MB more than 0')
+                print_usage_message()
+                exit_app(results_file, 2)
+            action_msg += add_action("Copy up to {0:g} MB at a time.".format(buffer_size / (1024 * 1024)))
+        elif opt == '--bwlimit':
+            try:
+                bandwidth = float(arg) * 1e6
+            except ValueError:
+                bandwidth = 0
+            if bandwidth <= 0:
+                print('Error! --bwlimit must be a number of MB/s more than 0')
+                print_usage_message()
+                exit_app(results_file, 2)
+            action_msg += add_action("Copy no faster than {0:g} MB/s.".format(bandwidth / 1e6))
+        elif opt == '--profile':
+            profile_file = arg
+            action_msg += add_action("Write profiling stats to: " + profile_file)
+        elif opt == '--resume':
+            resume = True
+            action_msg += add_action("Pick up where the last run on this folder stopped.")
+        elif opt == '--tz':
+            tz_name = arg
+            try:
+                timezone(tz_name)
+            except pytz.UnknownTimeZoneError:
+                print('Error! Unknown time zone: ' + tz_name)
+                print_usage_message()
+                exit_app(results_file, 2)
+
+    # Checking an archive is a command of its own, it doesn't copy or rename anything
+    if verify_dir != '':
+        if not os.path.isdir(verify_dir):
+            print("Error! Directory {0} does not exist".format(verify_dir))
+            exit_app(results_file, 2)
+        exit_app(results_file, 0 if verify_archive(verify_dir, workers if workers > 1 else VERIFY_WORKERS) else 1)
+
+    # Watching runs unattended, so nothing can be asked. A problem with some files shouldn't stop it.
+    if watch:
+        if all_subfolders or mode == "inplace":
+            print('Error! --watch can\'t be used with -a or --mode inplace')
+            print_usage_message()
+            exit_app(results_file, 2)
+        if not os.path.isdir(from_dir):
+            print("Error! Directory {0} does not exist".format(from_dir))
+            exit_app(results_file, 2)
+        interactive = False
+        if on_problem is None:
+            on_problem = "continue"
+            action_msg += add_action("If there is a problem: " + on_problem)
+
+    # Files renamed in place stay in the folder they are in
+    if layout != "flat" and mode == "inplace":
+        print('Error! --layout can\'t be used with --mode inplace')
+        print_usage_message()
+        exit_app(results_file, 2)
+
+    # Streaming is for one big folder, copied to a new one
+    if stream and (all_subfolders or watch or resume or mode == "inplace"):
+        print('Error! --stream can\'t be used with -a, --watch, --resume or --mode inplace')
+        print_usage_message()
+        exit_app(results_file, 2)
+
+    # Streaming copies files in the order it reads them
+    if stream and copy_order != "listing":
+        print('Error! --order can\'t be used with --stream')
+        print_usage_message()
+        exit_app(results_file, 2)
+
+    # Without a user to ask, everything we would have asked for has to be on the command line,
+    # and problems are handled by the --on-problem policy (stop, unless told otherwise)
+    if not interactive:
+        if on_problem is None:
+            on_problem = "abort"
+            action_msg += add_action("If there is a problem: " + on_problem)
+        missing = []
+        if from_dir == '' and all_subfolders == False:
+            missing.append('-f <foldername> or -a')
+        if site_name == '':
+            missing.append('-s <sitename>')
+        if convert_to_local_time and tz_name == '':
+            missing.append('--tz <zone> or -u')
+        if missing:
+            print('Error! In non-interactive mode these options are needed: ' + ', '.join(missing))
+            print_usage_message()
+            exit_app(results_file, 2)
 
     # append time type to action msg to confirm we are doing what they want
     if convert_to_local_time == True:
-        target_tz = getUserTimezone()
+        if tz_name != '':
+            target_tz = timezone(tz_name)
+        else:
+            target_tz = getUserTimezone()
         if target_tz == False:
             exit_app(results_file, 0)
         new_folder_modifier = "_LT"
@@ -400,8 +2541,10 @@ def main(argv):
 
         action_msg += add_action('Copy all files from: ' + from_dir)
 
-    # Create the results file in the source directory, erasing one if it was there before
-    results_file = open(from_dir + "/amresults.txt", "w+")
+    # Create the results file in the source directory (the current one for -a), erasing one if it was there before
+    results_dir = from_dir if from_dir != '' else '.'
+    results_file = ResultsLog(results_dir + "/amresults.txt", results_dir + "/amresults.jsonl" if write_jsonl else None,
+                              append=resume or watch)
 
     # User didn't pass a site name, so need to ask for it
     if site_name == '':
@@ -413,7 +2556,10 @@ def main(argv):
             if confirm[0].lower() == "c":
                 break
 
-        action_msg += add_action("Copy files to:       " + from_dir + new_folder_modifier)
+        if mode == "inplace":
+            action_msg += add_action("Rename files in:     " + from_dir)
+        else:
+            action_msg += add_action("Copy files to:       " + from_dir + new_folder_modifier)
     
     action_msg += add_action('Rename files using site name: ' + site_name)
     action_msg += add_action("For example, 20200605_003000.WAV will be renamed to " + site_name + "-2020-06-04_17-30.WAV")
@@ -422,7 +2568,7 @@ def main(argv):
     
     # confirm what they want before we do it   
     print(action_msg)
-    if input('Correct? (c = continue, anything else quits) ').lower() != 'c':
+    if interactive and input('Correct? (c = continue, anything else quits) ').lower() != 'c':
         print('Cancelling, user did not enter y to confirm.')
         exit_app(results_file, 0)
     
@@ -435,55 +2581,351 @@ def main(argv):
     # 2) For each folder, make a new directory and copy all files into it
     # 3) Walk through the new directory and rename each file
   
-    # If we are going through all subfolders, then start walking
-    # TODO: I haven't tested this in a while, is anybody going to use it?    
-    if all_subfolders == True:
-        if input("The \'Walk all subfolders\' feature has not been tested. Proceed at your own risk! (c) to continue, anything else to exit ").lower() != 'c':
-            exit_app(results_file, 1)
-
-        # Go through file system starting at current folder and validate all conditions
-        root_dir = os.path.abspath('.')
-        for dir_name, sub_dir_list, files in os.walk(root_dir):
-            debug('Found directory: %s' % dir_name)
-            
-            # If the root dir, check that it doesn't contain files
-            if dir_name == root_dir:
-                debug('Root dir, count of files = %s' % len(files))
-                if len(files) > 0:
-                    if input('Site directory contains files! a=abort, c=continue ') == 'a':
-                        exit_app(results_file, 1)
-
-            # This is not the root dir, but a subfolder. Ensure that there are no subfolders, and only .WAV files    
+    # Everything but the folder itself is the same for every folder we do
+    settings = Plan(from_dir, new_folder_modifier, site_name, target_tz, None, test_mode, mode, workers, direct, on_problem, write_jsonl,
+                    resume, header_mode, checksum, stream, catalog, catalog_match, layout, integrity, copy_order, buffer_size, bandwidth)
+
+    # Profile the rest of the run if asked. With --jobs the worker processes aren't included.
+    profiler = None
+    if profile_file != '':
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        try:
+            # If we are going through all subfolders, then start walking
+            if all_subfolders == True:
+                run_all_subfolders(settings, results_file, interactive, jobs)
+            elif watch:
+                watch_folder(settings, results_file)
+                exit_app(results_file, 0)
+            elif stream:
+                execute(settings, results_file)
             else:
-                debug('Count of subfolders = %s' % len(sub_dir_list))
-                if len(sub_dir_list) > 0:
-                    if input('Folder contains subfolders! a=abort, c=continue ').lower() == 'a':
-                        exit_app(results_file, 1)
-                validate_all_files(files, results_file)
-
-        # Assuming all is well, then do the copying and renaming
-        print('You have validated all the choices and confirmed any errors, so starting to copy and rename')
-        
-        # Note that we are only going to walk through the top-level folders, to avoid any subfolders that might erroneously be left around
-        for dir_name in next(os.walk(root_dir))[1]:
-        # for dir_name, sub_dir_list, files in os.walk(root_dir):
-            results_file.write('Found directory: %s' % dir_name)
-            print('Found directory: %s' % dir_name)
-            #if dir_name == root_dir:
-            #    debug('Skipping any files in root')
-            #else:
-                # be sure to skip subfolders in case the user hasn't cleaned them up
-            #    if len(sub_dir_list) == 0:
-            #        debug('Copying and renaming %s' % dir_name)
-            copy_and_rename_folder(dir_name, new_folder_modifier, site_name, target_tz, test_mode, results_file)      
-            
-    else:
-        for dir, subdirlist, files in os.walk(from_dir):
-            validate_all_files(files, results_file)
-        copy_and_rename_folder(from_dir, new_folder_modifier, site_name, target_tz, test_mode, results_file)
+                # Scan the folder once; validation, copy and rename all share the result
+                start = time.perf_counter()
+                settings.records = scan_folder(from_dir)
+                settings.scan_seconds = time.perf_counter() - start
+                execute(settings, results_file)
+        except AbortRun as why:
+            print("Stopping: {0}".format(why))
+            results_file.add("Stopped: {0}".format(why))
+            exit_app(results_file, 1)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_file)
+            print("Profiling stats written to {0}, see them with: python -m pstats {0}".format(profile_file))
 
     print("\n\n------------\nFinished! Look in file amresults.txt in the source folder for a report on what was done.\n------------\n")
     exit_app(results_file, 0)
 
 
-main(sys.argv[1:])
\ No newline at end of file
+#### Copy and rename one folder in a worker process, for run_all_subfolders with jobs > 1.
+#### The report for the folder goes into SECTION_FILE in the folder, which the main process then adds to
+#### the main report and deletes. Returns True/False like execute(), and the folder's RunStats.
+def run_folder_job(folder_plan):
+    section_file = ResultsLog(os.path.join(folder_plan.from_dir, SECTION_FILE),
+                              os.path.join(folder_plan.from_dir, SECTION_JSONL_FILE) if folder_plan.write_jsonl else None)
+    try:
+        return execute(folder_plan, section_file, validate=False), section_file.stats
+    finally:
+        section_file.close()
+
+
+#### Validate, copy and rename every folder under the current one (-a). settings is a Plan with everything
+#### except the folder filled in. jobs is how many folders to do at the same time, each in its own process.
+# TODO: I haven't tested this in a while, is anybody going to use it?    
+def run_all_subfolders(settings, results_file, interactive, jobs=1):
+    on_problem = settings.on_problem
+    if interactive and input("The \'Walk all subfolders\' feature has not been tested. Proceed at your own risk! (c) to continue, anything else to exit ").lower() != 'c':
+        exit_app(results_file, 1)
+
+    # Go through file system starting at current folder, once, and validate all conditions
+    root_dir = '.'
+    start = time.perf_counter()
+    tree = TreeScan(root_dir)
+    results_file.stats.add("scan", time.perf_counter() - start, tree.file_count)
+    start = time.perf_counter()
+    skip_dirs = set()
+    for dir_name, (records, sub_dir_list) in tree.folders.items():
+        debug('Found directory: %s' % dir_name)
+        
+        # If the root dir, check that it doesn't contain files
+        if dir_name == root_dir:
+            debug('Root dir, count of files = %s' % len(records))
+            if len(records) > 0:
+                if ask_user('Site directory contains files! a=abort, c=continue ', on_problem) == 'a':
+                    raise AbortRun('Site directory contains files')
+
+        # This is not the root dir, but a subfolder. Ensure that there are no subfolders, and only .WAV files    
+        else:
+            debug('Count of subfolders = %s' % len(sub_dir_list))
+            if len(sub_dir_list) > 0:
+                choice = ask_user('Folder contains subfolders! a=abort, c=continue ', on_problem)
+                if choice == 'a':
+                    raise AbortRun('Folder {0} contains subfolders'.format(dir_name))
+                if choice == 's':
+                    skip_dirs.add(dir_name)
+            if not validate_all_files(records, results_file, on_problem, settings.header_mode):
+                skip_dirs.add(dir_name)
+    results_file.stats.add("validate", time.perf_counter() - start, tree.file_count)
+
+    # Assuming all is well, then do the copying and renaming
+    print('You have validated all the choices and confirmed any errors, so starting to copy and rename')
+    
+    # Note that we are only going to walk through the top-level folders, to avoid any subfolders that might erroneously be left around
+    folder_plans = []
+    for dir_name in sorted(tree.subfolders(root_dir)):
+        if dir_name in skip_dirs:
+            results_file.add("Skipping folder:" + dir_name)
+            continue
+        folder_plan = copy.copy(settings)
+        folder_plan.from_dir = dir_name
+        folder_plan.records = tree.records(dir_name)
+        folder_plans.append(folder_plan)
+
+    print(tree.summary())
+    results_file.add(tree.summary())
+
+    if jobs <= 1:
+        for folder_plan in folder_plans:
+            results_file.write('Found directory: %s\n' % folder_plan.from_dir)
+            print('Found directory: %s' % folder_plan.from_dir)
+            execute(folder_plan, results_file, validate=False)
+        return
+
+    # Several folders at once. Worker processes can't ask the user anything, so problems are skipped
+    # unless there is a policy. Each worker writes its own report; they are added to the main report
+    # in folder order as they finish.
+    if settings.on_problem is None:
+        for folder_plan in folder_plans:
+            folder_plan.on_problem = "skip"
+    # Each process has its own limit, so between them they stay under the one asked for
+    if settings.bandwidth is not None and folder_plans:
+        for folder_plan in folder_plans:
+            folder_plan.bandwidth = settings.bandwidth / min(jobs, len(folder_plans))
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(run_folder_job, folder_plan) for folder_plan in folder_plans]
+        try:
+            for folder_plan, future in zip(folder_plans, futures):
+                try:
+                    folder_result, folder_stats = future.result()
+                    results_file.stats.merge(folder_stats)
+                finally:
+                    section = os.path.join(folder_plan.from_dir, SECTION_FILE)
+                    section_jsonl = os.path.join(folder_plan.from_dir, SECTION_JSONL_FILE)
+                    if os.path.exists(section):
+                        results_file.write('Found directory: %s\n' % folder_plan.from_dir)
+                        results_file.append_file(section, section_jsonl)
+                        os.remove(section)
+                    if os.path.exists(section_jsonl):
+                        os.remove(section_jsonl)
+        except AbortRun:
+            for future in futures:
+                future.cancel()
+            raise
+
+
+#### Watching a folder for new recordings (--watch)
+# A file counts as complete once its size hasn't changed for this many seconds
+WATCH_SETTLE_SECONDS = 5
+
+# Without inotify, how often to look at the folder again
+WATCH_POLL_SECONDS = 5
+
+# Most files copied and renamed in one go, so a whole card arriving at once is worked through a bit at a
+# time as its files finish, instead of all at the end
+WATCH_BATCH_SIZE = 20
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+#### Linux inotify on one folder, through the C library so nothing needs installing. Use open_inotify()
+#### rather than making one of these directly, as not every system has inotify.
+class InotifyWatch:
+    def __init__(self, dir_name):
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(dir_name), IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, "inotify_add_watch failed on " + dir_name)
+
+    #### Wait up to timeout seconds (None = until something happens) and return the set of names that
+    #### changed, or None if the kernel dropped events and the whole folder has to be looked at again.
+    def wait(self, timeout):
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+        names = set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return names
+        pos = 0
+        while pos + INOTIFY_EVENT.size <= len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, pos)
+            pos += INOTIFY_EVENT.size
+            if mask & IN_Q_OVERFLOW:
+                return None
+            name = data[pos:pos + length].rstrip(b"\0")
+            pos += length
+            if name:
+                names.add(os.fsdecode(name))
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+#### An InotifyWatch on dir_name, or None if this system doesn't have inotify
+def open_inotify(dir_name):
+    try:
+        return InotifyWatch(dir_name)
+    except (OSError, AttributeError):
+        # AttributeError: the C library has no inotify_init1, e.g. macOS
+        return None
+
+
+#### Keep copying and renaming recordings as they turn up in settings.from_dir, until stopped with Ctrl-C
+#### (or SIGTERM). settings is a Plan. Files are only picked up once they have stopped growing, and the
+#### folder's journal is used to know which files have already been done, so it can be stopped and
+#### started again without copying anything twice. Files that aren't recordings are reported and left alone.
+def watch_folder(settings, results_file, batch_size=WATCH_BATCH_SIZE, settle_seconds=WATCH_SETTLE_SECONDS,
+                 poll_seconds=WATCH_POLL_SECONDS):
+    watch_dir = settings.from_dir
+    journal = Journal(os.path.join(watch_dir, "amjournal.jsonl"), resume=True)
+    manifest = None
+    if settings.checksum and not settings.test_mode:
+        manifest = Manifest(settings.to_dir())
+    catalogue = None
+    if settings.catalog is not None:
+        catalogue = Catalogue(settings.catalog, settings.site_name, settings.catalog_match, read_only=settings.test_mode)
+    # One schedule for the whole watch, so the bandwidth limit carries over from one batch to the next
+    schedule = CopySchedule(settings.copy_order, settings.buffer_size, settings.bandwidth)
+    # The names in the destination folder are listed once here, and then kept up to date batch by batch
+    taken_names = TakenNames(settings.to_dir(), settings.layout)
+    watcher = open_inotify(watch_dir)
+    if watcher is not None:
+        msg = "Watching {0} for new recordings".format(watch_dir)
+    else:
+        msg = "Watching {0} for new recordings, looking every {1} seconds".format(watch_dir, poll_seconds)
+    print(msg + ". Ctrl-C to stop.")
+    results_file.add(msg)
+    results_file.flush()
+
+    # A service manager stops us with SIGTERM; treat it like Ctrl-C so the logs get written out
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+
+    pending = {}    # name -> (size, time its size last changed)
+    ignored = set() # names that aren't recordings, already reported
+    changed = None  # names inotify says changed, or None to look at the whole folder
+    try:
+        while True:
+            if watcher is None or changed is None:
+                found = {record.name: record.size for record in scan_folder(watch_dir)}
+                for name in set(pending) - set(found):
+                    del pending[name]
+            else:
+                found = {}
+                for name in changed | set(pending):
+                    try:
+                        found[name] = os.stat(os.path.join(watch_dir, name)).st_size
+                    except FileNotFoundError:
+                        pending.pop(name, None)
+
+            now = time.monotonic()
+            for name, size in found.items():
+                if name in RESULTS_FILES or name in ignored or journal.is_done("copy", os.path.join(watch_dir, name).replace('\\', '/')):
+                    continue
+                if name not in pending or pending[name][0] != size:
+                    pending[name] = (size, now)
+
+            # Everything that has stopped growing, oldest first
+            ready = sorted((since, name) for name, (size, since) in pending.items() if now - since >= settle_seconds)
+            batch = []
+            for since, name in ready[:batch_size]:
+                batch.append(make_record(watch_dir, name, pending.pop(name)[0]))
+            if batch:
+                watch_batch(settings, batch, ignored, results_file, journal, manifest, catalogue, schedule, taken_names)
+
+            if len(ready) > batch_size:
+                timeout = 0
+            elif pending:
+                timeout = min(1.0, settle_seconds)
+            else:
+                timeout = None if watcher is not None else poll_seconds
+            if watcher is not None:
+                changed = watcher.wait(timeout)
+            else:
+                time.sleep(poll_seconds if timeout is None else max(timeout, 0.1))
+    except KeyboardInterrupt:
+        print("Stopped watching " + watch_dir)
+        results_file.add("Stopped watching " + watch_dir)
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        if watcher is not None:
+            watcher.close()
+        journal.close()
+        if manifest is not None:
+            manifest.save(results_file)
+        if catalogue is not None:
+            catalogue.close()
+
+
+#### Copy and rename one batch of complete files for watch_folder. Anything that isn't a recording, is
+#### damaged (with --integrity skip) or is already in the catalogue is reported, added to ignored and left where it is.
+def watch_batch(settings, batch, ignored, results_file, journal, manifest, catalogue=None, schedule=None, taken_names=None):
+    if settings.header_mode is not None:
+        apply_header_times(batch, settings.header_mode, results_file)
+    records = []
+    for record in batch:
+        if record.valid:
+            records.append(record)
+            continue
+        if not iswavfile(record.name):
+            msg = "{0} is not a WAV file, leaving it alone".format(record.path)
+        else:
+            msg = "{0} is neither a hex-named file nor a valid date-named file, leaving it alone".format(record.path)
+        print(msg)
+        results_file.add(msg)
+        ignored.add(record.name)
+
+    if settings.integrity is not None and records:
+        checked = check_integrity(records, settings.integrity, results_file, max(settings.workers, INTEGRITY_WORKERS))
+        ignored.update(record.name for record in records if record not in checked)
+        records = checked
+
+    if catalogue is not None and records:
+        new_records = catalogue.skip_known(records, results_file)
+        ignored.update(record.name for record in records if record not in new_records)
+        records = new_records
+
+    if records:
+        results_file.add("New recordings: {0}".format(len(records)))
+        # The destination folder is expected to be there after the first batch, so this always "resumes"
+        copy_and_rename_with_journal(settings.from_dir, settings.new_folder_modifier, settings.site_name, settings.target_tz,
+                                     settings.test_mode, results_file, records, settings.workers, settings.mode, settings.direct,
+                                     settings.on_problem, True, journal, manifest, catalogue=catalogue, layout=settings.layout,
+                                     schedule=schedule, taken_names=taken_names)
+        if manifest is not None:
+            manifest.save(results_file)
+        if catalogue is not None:
+            catalogue.commit()
+    journal.flush()
+    results_file.flush()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
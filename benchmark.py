@@ -0,0 +1,289 @@
+"""
+Benchmark for AMRename. Makes a synthetic tree of AudioMoth recordings in a temporary folder, then times
+each step AMRename goes through (scan, validate, copy, rename, and writing the report) and saves the
+results as JSON, so different versions of the script can be compared.
+
+The tree looks like what -a expects: a root folder with one folder per site, each full of recordings.
+Some have hex names and some YYYYMMDD_HHMMSS names, and a few are recorded in the same minute as
+another one so that renaming has name collisions to sort out.
+
+Examples:
+    python benchmark.py                          1000 files, results printed
+    python benchmark.py -n 100000 -o before.json
+    python benchmark.py -n 1000000 --size 0 --sites 20 --workers 8 -o after.json
+    python benchmark.py -n 2000 --size 4000000 --order disk -o disk.json
+"""
+
+
+import time
+import calendar
+import os
+import shutil
+import sys, getopt
+import json
+import platform
+import random
+import subprocess
+import tempfile
+
+import AMRename
+
+
+#### function to print the usage message
+def print_usage_message():
+    print('Benchmark options:')
+    print('   -n <N>            Number of files to make (default 1000)')
+    print('   --sites <N>       Number of site folders to spread them over (default 4)')
+    print('   --size <bytes>    Size of each file (default 4096)')
+    print('   --hex <fraction>  Fraction of files with hex names rather than YYYYMMDD_HHMMSS (default 0.5)')
+    print('   --collisions <f>  Fraction of files recorded in the same minute as the one before (default 0.05)')
+    print('   --workers <N>     Files to copy at the same time (default 1)')
+    print('   --mode <mode>     copy (default), hardlink or reflink')
+    print('   --order <o>       Order to copy the files in: listing (default), disk or time')
+    print('   --buffer <MB>     Copy buffer size (default 1)')
+    print('   --tz <zone>       Time zone to rename into (default America/Los_Angeles)')
+    print('   --dir <folder>    Where to make the temporary tree (default: the system temp folder)')
+    print('   --seed <N>        Random seed, so runs make the same tree (default 1)')
+    print('   --keep            Don\'t delete the tree afterwards')
+    print('   -o <file>         Save the results as JSON to <file> as well as printing them')
+    print('   -h                Display this help screen')
+
+
+# Recordings start at 2020-01-01 00:00:00 UTC and are this many seconds apart
+FIRST_RECORDING = calendar.timegm((2020, 1, 1, 0, 0, 0))
+RECORDING_INTERVAL = 600
+
+
+#### Make the synthetic tree under root_dir: files recordings shared between sites folders.
+#### Returns the names of the site folders.
+def make_tree(root_dir, files, sites, size, hex_fraction, collision_fraction, seed):
+    rng = random.Random(seed)
+    data = bytes(rng.getrandbits(8) for i in range(min(size, 64 * 1024)))
+    site_dirs = ["site{0:03d}".format(i) for i in range(sites)]
+    for site_dir in site_dirs:
+        os.mkdir(os.path.join(root_dir, site_dir))
+
+    for i in range(files):
+        site_dir = site_dirs[i % sites]
+        n = i // sites
+        timestamp = FIRST_RECORDING + n * RECORDING_INTERVAL
+        if n > 0 and rng.random() < collision_fraction:
+            # Same minute as the last one in this site, so both get the same new name
+            timestamp = FIRST_RECORDING + (n - 1) * RECORDING_INTERVAL + 30
+        if rng.random() < hex_fraction:
+            name = "{0:08X}.WAV".format(timestamp)
+        else:
+            name = time.strftime("%Y%m%d_%H%M%S.WAV", time.gmtime(timestamp))
+        with open(os.path.join(root_dir, site_dir, name), "wb") as f:
+            remaining = size
+            while remaining > 0:
+                f.write(data[:remaining])
+                remaining -= len(data)
+    return site_dirs
+
+
+#### A ResultsLog that adds up the time spent writing to disk, which is the cost of the report
+class TimedResultsLog(AMRename.ResultsLog):
+    def __init__(self, *args, **kwargs):
+        self.seconds = 0.0
+        AMRename.ResultsLog.__init__(self, *args, **kwargs)
+
+    def flush(self):
+        start = time.perf_counter()
+        AMRename.ResultsLog.flush(self)
+        self.seconds += time.perf_counter() - start
+
+
+#### Seconds, and files and MB a second, for one phase
+def phase_result(seconds, files, total_bytes):
+    result = {"seconds": round(seconds, 6), "files": files,
+              "files_per_second": round(files / seconds, 1) if seconds > 0 else None}
+    if total_bytes is not None:
+        result["bytes"] = total_bytes
+        result["mb_per_second"] = round(total_bytes / 1e6 / seconds, 1) if seconds > 0 else None
+    return result
+
+
+#### Which version of AMRename is being measured, if this is a git checkout
+def script_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+#### Make the tree in root_dir and time each phase on it. Returns the results as a dict.
+#### Like -a, this works from inside the root folder, so it changes to it while it runs.
+def run_benchmark(root_dir, files, sites, size, hex_fraction, collision_fraction, workers, mode, tz_name, seed, order="listing",
+                  buffer_size=AMRename.COPY_BUFFER_SIZE):
+    old_dir = os.getcwd()
+    os.chdir(root_dir)
+    try:
+        return run_phases(files, sites, size, hex_fraction, collision_fraction, workers, mode, tz_name, seed, order, buffer_size)
+    finally:
+        os.chdir(old_dir)
+
+
+#### The work of run_benchmark, in the root folder
+def run_phases(files, sites, size, hex_fraction, collision_fraction, workers, mode, tz_name, seed, order, buffer_size):
+    target_tz = AMRename.timezone(tz_name)
+    schedule = AMRename.CopySchedule(order, buffer_size)
+    site_name = "BENCHam"
+
+    start = time.perf_counter()
+    site_dirs = make_tree('.', files, sites, size, hex_fraction, collision_fraction, seed)
+    generate_seconds = time.perf_counter() - start
+
+    results_file = TimedResultsLog("amresults.txt", "amresults.jsonl")
+    phases = {}
+
+    # The phases are run one after the other over every site, the same as -a does them
+    start = time.perf_counter()
+    tree = AMRename.TreeScan('.')
+    phases["scan"] = phase_result(time.perf_counter() - start, tree.file_count, None)
+
+    records = {site_dir: tree.records(site_dir) for site_dir in site_dirs}
+    total_bytes = sum(record.size for site_records in records.values() for record in site_records)
+
+    start = time.perf_counter()
+    for site_dir in site_dirs:
+        AMRename.validate_all_files(records[site_dir], results_file, "continue")
+    phases["validate"] = phase_result(time.perf_counter() - start, files, None)
+
+    start = time.perf_counter()
+    copy_ok = True
+    for site_dir in site_dirs:
+        to_dir = site_dir + "_LT"
+        os.mkdir(to_dir)
+        if not AMRename.copy_files_to_new_dir(site_dir, to_dir, False, results_file, records[site_dir], workers, mode,
+                                              schedule=schedule):
+            copy_ok = False
+    phases["copy"] = phase_result(time.perf_counter() - start, files, total_bytes)
+
+    # rename_files() counts a same-minute collision as an error, and the tree has those on purpose,
+    # so only the copy is checked
+    start = time.perf_counter()
+    for site_dir in site_dirs:
+        AMRename.rename_files(site_dir + "_LT", site_name, target_tz, False, results_file, records[site_dir])
+    phases["rename"] = phase_result(time.perf_counter() - start, files, None)
+
+    results_file.close()
+    log_bytes = os.path.getsize("amresults.txt") + os.path.getsize("amresults.jsonl")
+    # Writing the report happens during the other phases, so this time is also part of theirs
+    phases["log"] = phase_result(results_file.seconds, files, log_bytes)
+
+    return {
+        "amrename_version": script_version(),
+        "when": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {"files": files, "sites": sites, "size": size, "hex_fraction": hex_fraction,
+                     "collision_fraction": collision_fraction, "workers": workers, "mode": mode, "tz": tz_name, "seed": seed,
+                     "order": order, "buffer_size": buffer_size},
+        "generate_seconds": round(generate_seconds, 6),
+        "copy_ok": copy_ok,
+        "phases": phases,
+    }
+
+
+#### Main
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "hn:o:", ["sites=", "size=", "hex=", "collisions=", "workers=", "mode=", "tz=", "dir=",
+                                                   "seed=", "keep", "order=", "buffer="])
+    except getopt.GetoptError:
+        print('Error! Wrong arguments were entered')
+        print_usage_message()
+        sys.exit(2)
+    if len(args) > 0:
+        print('Error! Too many arguments were entered')
+        print_usage_message()
+        sys.exit(3)
+
+    files = 1000
+    sites = 4
+    size = 4096
+    hex_fraction = 0.5
+    collision_fraction = 0.05
+    workers = 1
+    mode = "copy"
+    order = "listing"
+    buffer_size = AMRename.COPY_BUFFER_SIZE
+    tz_name = "America/Los_Angeles"
+    base_dir = None
+    seed = 1
+    keep = False
+    output = ''
+
+    try:
+        for opt, arg in opts:
+            if opt == '-h':
+                print_usage_message()
+                sys.exit(0)
+            elif opt == '-n':
+                files = int(arg)
+            elif opt == '--sites':
+                sites = int(arg)
+            elif opt == '--size':
+                size = int(arg)
+            elif opt == '--hex':
+                hex_fraction = float(arg)
+            elif opt == '--collisions':
+                collision_fraction = float(arg)
+            elif opt == '--workers':
+                workers = int(arg)
+            elif opt == '--mode':
+                mode = arg.lower()
+            elif opt == '--order':
+                order = arg.lower()
+            elif opt == '--buffer':
+                buffer_size = int(float(arg) * 1024 * 1024)
+            elif opt == '--tz':
+                tz_name = arg
+            elif opt == '--dir':
+                base_dir = arg
+            elif opt == '--seed':
+                seed = int(arg)
+            elif opt == '--keep':
+                keep = True
+            elif opt == '-o':
+                output = arg
+    except ValueError as why:
+        print('Error! {0}'.format(why))
+        print_usage_message()
+        sys.exit(2)
+
+    if files < 1 or sites < 1 or size < 0 or workers < 1:
+        print('Error! -n, --sites and --workers must be at least 1, and --size can\'t be negative')
+        sys.exit(2)
+    if mode not in AMRename.INGEST_MODES or mode == "inplace":
+        print('Error! --mode must be copy, hardlink or reflink')
+        sys.exit(2)
+    if order not in AMRename.COPY_ORDERS:
+        print('Error! --order must be one of: ' + ', '.join(AMRename.COPY_ORDERS))
+        sys.exit(2)
+    if buffer_size < 1:
+        print('Error! --buffer must be more than 0')
+        sys.exit(2)
+
+    root_dir = tempfile.mkdtemp(prefix="amrename-bench-", dir=base_dir)
+    print("Making {0} files in {1}".format(files, root_dir))
+    try:
+        results = run_benchmark(root_dir, files, sites, size, hex_fraction, collision_fraction, workers, mode, tz_name, seed,
+                                order, buffer_size)
+    finally:
+        if keep:
+            print("Kept the tree in " + root_dir)
+        else:
+            shutil.rmtree(root_dir)
+
+    text = json.dumps(results, indent=2)
+    print(text)
+    if output != '':
+        with open(output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
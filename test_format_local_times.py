@@ -0,0 +1,62 @@
+"""
+Checks that format_local_times() names files exactly as the original astimezone() + strftime() code did,
+so that speeding it up can never change a file name. Run with: python -m pytest
+"""
+
+
+import random
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+
+import AMRename
+
+
+# Zones with DST, with 30 and 45 minute offsets, with a 30 minute DST change, and ones that never change
+ZONES = ["UTC", "Etc/GMT+5", "America/Los_Angeles", "America/New_York", "America/Phoenix", "America/St_Johns",
+         "Europe/London", "Asia/Kolkata", "Asia/Kathmandu", "Australia/Adelaide", "Australia/Lord_Howe", "Pacific/Chatham"]
+
+# Everything a 32 bit hex name can hold, plus the years before 1970 a YYYYMMDD_HHMMSS name can
+FIRST_TIMESTAMP = -2208988800    # 1900-01-01
+LAST_TIMESTAMP = 2 ** 32 - 1
+
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+
+#### The name the original script gave a recording made at timestamp
+def reference_time_str(timestamp, target_tz):
+    return (EPOCH + timedelta(seconds=timestamp)).astimezone(target_tz).strftime('%Y-%m-%d_%H-%M')
+
+
+def check(timestamps, target_tz):
+    expected = [reference_time_str(timestamp, target_tz) for timestamp in timestamps]
+    assert AMRename.format_local_times(timestamps, target_tz) == expected
+
+
+@pytest.mark.parametrize("zone", ZONES)
+def test_random_times(zone):
+    rng = random.Random(zone)
+    check([rng.randint(FIRST_TIMESTAMP, LAST_TIMESTAMP) for i in range(20000)], pytz.timezone(zone))
+
+
+@pytest.mark.parametrize("zone", ZONES)
+def test_around_dst_changes(zone):
+    target_tz = pytz.timezone(zone)
+    epoch = datetime(1970, 1, 1)
+    changes = [int((t - epoch).total_seconds()) for t in getattr(target_tz, "_utc_transition_times", [])[1:]]
+    timestamps = [change + delta for change in changes for delta in (-3601, -1801, -61, -1, 0, 1, 59, 1799, 3599)
+                  if FIRST_TIMESTAMP <= change + delta <= LAST_TIMESTAMP]
+    check(timestamps, target_tz)
+
+
+#### Zones that never change offset have a one entry table of their own
+@pytest.mark.parametrize("zone", ["UTC", "Etc/GMT+5", "Etc/GMT-14"])
+def test_fixed_offset_zones(zone):
+    target_tz = pytz.timezone(zone)
+    assert AMRename.utc_offset_table(zone)[0] == [0]
+    check([FIRST_TIMESTAMP, -1, 0, 1, 86399, 86400, 1591313400, LAST_TIMESTAMP], target_tz)
+
+
+def test_no_time():
+    assert AMRename.format_local_times([None, 0, None], pytz.utc) == [None, "1970-01-01_00-00", None]